@@ -0,0 +1,213 @@
+"""
+Compiles a contract tree into one flat, specialized python function.
+
+The combinators of contract.py nest one contract call per level and
+per element. A contract built from type_of, list_of, dict_of, prodn,
+prods, coprodn and coprods exposes its structure (see the Contract
+class), so it can be translated into python source that does the same
+checks inline, in one frame:
+
+    compile_contract(list_of(prods({'i': int_t, 's': string_t})))
+
+The compiled function accepts and rejects exactly the same values as
+the contract it was compiled from. Any other callable in the tree is
+treated as an opaque contract and simply called.
+"""
+
+from contract import int_t, string_t, list_of, dict_of, prodn, prods, coprodn, coprods, any_t, expect_type_error
+
+## Raises the same error as the contracts built by type_of
+def type_error(t, x):
+    raise TypeError('{type} is expected found {found}: {value}'.format(type=t, found=type(x), value=x))
+
+class Generator(object):
+    """ Emits the source of the compiled contract, one statement per line """
+
+    def __init__(self):
+        self.lines = []
+        self.namespace = {'type_error': type_error}
+        self.counter = 0
+
+    def fresh(self, prefix):
+        self.counter += 1
+        return '{p}{n}'.format(p=prefix, n=self.counter)
+
+    def constant(self, value):
+        n = self.fresh('k')
+        self.namespace[n] = value
+        return n
+
+    def emit(self, depth, line):
+        self.lines.append('    ' * depth + line)
+
+    def raise_type_error(self, depth, message):
+        self.emit(depth, 'raise TypeError({m!r})'.format(m=message))
+
+    def check_type(self, depth, t, v):
+        k = self.constant(t)
+        self.emit(depth, 'if not isinstance({v}, {k}): type_error({k}, {v})'.format(v=v, k=k))
+
+    ## Emits the code checking the value in variable v against contract c,
+    ## returns the variable holding the result of the contract.
+    def contract(self, depth, c, v):
+        kind = getattr(c, 'kind', None)
+        handler = getattr(self, 'gen_' + str(kind), None)
+        if handler is None:
+            return self.gen_opaque(depth, c, v)
+        return handler(depth, c, v)
+
+    def gen_opaque(self, depth, c, v):
+        if c is any_t:
+            return v
+        r = self.fresh('r')
+        self.emit(depth, '{r} = {k}({v})'.format(r=r, k=self.constant(c), v=v))
+        return r
+
+    def gen_type_of(self, depth, c, v):
+        self.check_type(depth, c.type, v)
+        return v
+
+    def gen_list_of(self, depth, c, v):
+        self.check_type(depth, list, v)
+        r = self.fresh('r')
+        x = self.fresh('v')
+        self.emit(depth, '{r} = []'.format(r=r))
+        self.emit(depth, 'for {x} in {v}:'.format(x=x, v=v))
+        self.emit(depth + 1, '{r}.append({e})'.format(r=r, e=self.contract(depth + 1, c.children[0], x)))
+        return r
+
+    def gen_dict_of(self, depth, c, v):
+        self.check_type(depth, dict, v)
+        r = self.fresh('r')
+        k = self.fresh('key')
+        x = self.fresh('v')
+        self.emit(depth, '{r} = {{}}'.format(r=r))
+        self.emit(depth, 'for {k} in {v}:'.format(k=k, v=v))
+        self.emit(depth + 1, '{x} = {v}[{k}]'.format(x=x, v=v, k=k))
+        self.emit(depth + 1, '{r}[{k}] = {e}'.format(r=r, k=k, e=self.contract(depth + 1, c.children[0], x)))
+        return r
+
+    def check_length(self, depth, v, length, message):
+        self.emit(depth, 'if len({v}) != {l}:'.format(v=v, l=length))
+        self.raise_type_error(depth + 1, message)
+
+    def gen_prodn(self, depth, c, v):
+        if c.multi_args_fun:
+            return self.gen_opaque(depth, c, v)
+        self.check_type(depth, list, v)
+        length = len(c.children)
+        self.check_length(depth, v, length, "Expected {length} arguments".format(length=length))
+        results = []
+        for i, ci in enumerate(c.children):
+            x = self.fresh('v')
+            self.emit(depth, '{x} = {v}[{i}]'.format(x=x, v=v, i=i))
+            results.append(self.contract(depth, ci, x))
+        r = self.fresh('r')
+        self.emit(depth, '{r} = [{rs}]'.format(r=r, rs=', '.join(results)))
+        return r
+
+    def gen_prods(self, depth, c, v):
+        self.check_type(depth, dict, v)
+        length = len(c.children)
+        self.check_length(depth, v, length, "Expected {length} arguments".format(length=length))
+        r = self.fresh('r')
+        self.emit(depth, '{r} = {{}}'.format(r=r))
+        for key, ci in c.children:
+            k = self.constant(key)
+            x = self.fresh('v')
+            self.emit(depth, '{x} = {v}[{k}]'.format(x=x, v=v, k=k))
+            self.emit(depth, '{r}[{k}] = {e}'.format(r=r, k=k, e=self.contract(depth, ci, x)))
+        return r
+
+    ## Emits the if/elif chain of a coproduct, one branch per tag
+    def branches(self, depth, tag, value, r, cases):
+        keyword = 'if'
+        for key, ci in cases:
+            self.emit(depth, '{kw} {t} == {k}:'.format(kw=keyword, t=tag, k=self.constant(key)))
+            self.emit(depth + 1, '{r} = {e}'.format(r=r, e=self.contract(depth + 1, ci, value)))
+            keyword = 'elif'
+        return keyword
+
+    def gen_coprodn(self, depth, c, v):
+        length = len(c.children)
+        self.check_type(depth, list, v)
+        tag = self.fresh('t')
+        self.emit(depth, '{t} = {v}[0]'.format(t=tag, v=v))
+        self.check_type(depth, int, tag)
+        self.check_length(depth, v, 2, "Expected [int_t, any_t]")
+        self.emit(depth, 'if {t} >= {l}:'.format(t=tag, l=length))
+        self.raise_type_error(depth + 1, "Tag out of range.")
+        # negative tags index the contracts from the end, as a list does
+        index = self.fresh('i')
+        self.emit(depth, '{i} = {t} + {l} if {t} < 0 else {t}'.format(i=index, t=tag, l=length))
+        value = self.fresh('v')
+        self.emit(depth, '{x} = {v}[1]'.format(x=value, v=v))
+        r = self.fresh('r')
+        keyword = self.branches(depth, index, value, r, enumerate(c.children))
+        self.emit(depth, 'else:' if keyword == 'elif' else 'if True:')
+        self.emit(depth + 1, "raise IndexError('list index out of range')")
+        result = self.fresh('r')
+        self.emit(depth, '{res} = [{t}, {r}]'.format(res=result, t=tag, r=r))
+        return result
+
+    def gen_coprods(self, depth, c, v):
+        self.check_type(depth, list, v)
+        tag = self.fresh('t')
+        self.emit(depth, '{t} = {v}[0]'.format(t=tag, v=v))
+        self.check_type(depth, str, tag)
+        self.check_length(depth, v, 2, "Expected [string_t, any_t]")
+        value = self.fresh('v')
+        r = self.fresh('r')
+        self.emit(depth, '{x} = {v}[1]'.format(x=value, v=v))
+        keyword = self.branches(depth, tag, value, r, c.children)
+        self.emit(depth, 'else:' if keyword == 'elif' else 'if True:')
+        self.emit(depth + 1, 'raise TypeError("Unknown tag: {{tag}}".format(tag={t}))'.format(t=tag))
+        result = self.fresh('r')
+        self.emit(depth, '{res} = [{t}, {r}]'.format(res=result, t=tag, r=r))
+        return result
+
+    def function(self, c):
+        self.emit(0, 'def compiled(v0):')
+        r = self.contract(1, c, 'v0')
+        self.emit(1, 'return {r}'.format(r=r))
+        return '\n'.join(self.lines) + '\n'
+
+## Compiles the given contract into a single python function, the
+## generated source is kept in the source attribute of the result.
+def compile_contract(c):
+    g = Generator()
+    source = g.function(c)
+    exec compile(source, '<contract>', 'exec') in g.namespace
+    compiled = g.namespace['compiled']
+    compiled.source = source
+    return compiled
+
+def compile_contract_test():
+    records = list_of(prods({'i': int_t, 's': string_t}))
+    compiled = compile_contract(records)
+    print compiled.source
+    x = [{'i': 1, 's': 'a'}, {'i': 2, 's': 'b'}]
+    print compiled(x)
+    if compiled(x) != records(x):
+        raise Exception("Compiled contract differs from the original")
+    for bad in [{'i': 1}, [{'i': 1, 's': 2}], [{'i': 1}], [5]]:
+        if expect_type_error(compiled, bad) != expect_type_error(records, bad):
+            raise Exception("Compiled contract rejects {x} differently".format(x=bad))
+
+def compile_coproduct_test():
+    tagged = coprods({'n': prodn([int_t, dict_of(string_t)]), 'l': list_of(coprodn([int_t, string_t]))})
+    compiled = compile_contract(tagged)
+    for good in [['n', [1, {'a': 'b'}]], ['l', [[0, 1], [1, 'x'], [-1, 'y']]]]:
+        if compiled(good) != tagged(good):
+            raise Exception("Compiled contract differs from the original")
+        print compiled(good)
+    for bad in [['x', 1], ['n', [1, {'a': 1}]], ['l', [[2, 1]]], ['l', [[0, 'x']]], ['n', 1, 2]]:
+        if expect_type_error(compiled, bad) != expect_type_error(tagged, bad):
+            raise Exception("Compiled contract rejects {x} differently".format(x=bad))
+
+def main():
+    compile_contract_test()
+    compile_coproduct_test()
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,9 @@
 
-from contract import just, nothing, try_ok, try_error, try_monad, listMonad, maybeMonad
+from contract import just, nothing, try_ok, try_error, try_monad, listMonad, maybeMonad, lazyListMonad
 from ast import *
 from uncompile import monadic, monadic_comp
 import inspect
+import itertools
 
 def l_to_n(n):
     return range(0, n)
@@ -14,6 +15,13 @@ def f():
          ]
     print xs
 
+@monadic_comp(lazyListMonad)
+def fl():
+    xs = [ (x, y) for x in xrange(10 ** 9)
+                  for y in xrange(10 ** 9)
+         ]
+    print list(itertools.islice(xs, 0, 3))
+
 def div(x, y):
     if y == 0:
         return nothing
@@ -27,6 +35,11 @@ def g(z):
          ]
     print xs
 
+@monadic_comp(maybeMonad)
+def gx(x):
+    xs = [ x for x in div(x, 2) ]
+    print xs
+
 def try_div(x, y):
     if y == 0:
         return try_error("divisor was zero")
@@ -57,8 +70,10 @@ def hb(z):
 
 def main():
     f()
+    fl()
     g(2)
     g(0)
+    gx(8)
     h(2)
     h(0)
     print fb()
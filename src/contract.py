@@ -2,7 +2,14 @@
 """ A contract consits of a type check of a given variable """
 
 import array
+import collections
+import itertools
+import math
+import os
+import sys
+import time
 import types
+import weakref
 
 # Category
 
@@ -10,19 +17,243 @@ import types
 ## - contract as an object
 ## - guarded functions as a morphism
 
+## Contracts are callable objects which remember how they were built:
+## the kind of the combinator, the child contracts and the checked type.
+## Two contracts built the same way are equal and have the same hash,
+## so the structure can be inspected, cached, compared and compiled.
+class Contract(object):
+    __slots__ = ('kind', 'children', 'type', 'hash', 'recursive', 'preserving', 'fast', '__weakref__')
+
+    def __init__(self, kind, children=(), type=None):
+        self.kind = kind
+        self.children = tuple(children)
+        self.type = type
+        self.hash = hash(self.key())
+        self.recursive = any(getattr(c, 'recursive', False) for c in self.child_contracts())
+        self.preserving = False
+        self.fast = self
+
+    def child_contracts(self):
+        return self.children
+
+    ## The structural identity of the contract
+    def key(self):
+        return (self.__class__, self.kind, self.type, self.children)
+
+    def __hash__(self):
+        return self.hash
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if not isinstance(other, Contract) or self.hash != other.hash:
+            return False
+        return self.key() == other.key()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        parts = [contract_name(c) for c in self.children]
+        if self.type is not None:
+            parts = [repr(self.type)] + parts
+        return '{kind}({parts})'.format(kind=self.kind, parts=', '.join(parts))
+
+    ## Validate only mode of the contract (see validate_only)
+    def check(self, x):
+        return self(x)
+
+    ## One step of the iterative evaluation (see run): puts the result
+    ## for x into out[i] and pushes the checks of the children, if any,
+    ## to the work stack.
+    def step(self, x, out, i, stack):
+        out[i] = self(x)
+
+## Structurally identical contracts are shared: the intern table maps a
+## structure to the one live contract built that way. It only holds weak
+## references, so the entries of unused contracts are dropped as they are
+## collected, and a contract stays shared as long as it lives.
+class InternTable(object):
+    def __init__(self):
+        self.table = weakref.WeakValueDictionary()
+
+    def lookup(self, key):
+        return self.table.get(key)
+
+    def share(self, key, value):
+        shared = self.table.get(key)
+        if shared is not None:
+            return shared
+        self.table[key] = value
+        return value
+
+intern_table = InternTable()
+
+def intern(contract):
+    return intern_table.share(contract.key(), contract)
+
+## Shares the contracts built by a contract builder, e.g. list_c(int_t)
+## is built once and every later call returns the same contract. The
+## builders build other contracts at other contract levels.
+def interned(builder):
+    def build(*args):
+        key = (builder, contract_level) + args
+        shared = intern_table.lookup(key)
+        if shared is None:
+            shared = intern_table.share(key, builder(*args))
+        return shared
+    build.__name__ = builder.__name__
+    build.__doc__ = builder.__doc__
+    return build
+
+## A contract is preserving when in validate only mode it returns the
+## checked value itself, e.g. type_of(t) or a list_of a preserving contract.
+def preserving(c):
+    return getattr(c, 'preserving', False)
+
+def all_preserving(cs):
+    return all(preserving(c) for c in cs)
+
+def checker(c):
+    if isinstance(c, Contract):
+        return c.check
+    return c
+
+## Contract levels: with FULL every contract checks everything, with
+## BOUNDARY the containers only check their own shape, e.g. list_of(int_t)
+## checks that its argument is a list, and with OFF the builders build no
+## checks at all, e.g. hom(int_t, int_t)(f) is f itself and list_c(int_t)
+## returns its value. The primitives, e.g. int_t, are the same at every
+## level. Only the checks are left out, containers mapping transforming
+## functions, e.g. list_of(upTo), keep mapping. The level is read from the
+## CONTRACT_LEVEL environment variable and applies to the contracts built
+## after it is set.
+OFF, BOUNDARY, FULL = 'off', 'boundary', 'full'
+contract_levels = (OFF, BOUNDARY, FULL)
+contract_level = FULL
+
+def set_contract_level(level):
+    global contract_level
+    if level not in contract_levels:
+        raise TypeError("Expected one of {levels} found {level}".format(levels=contract_levels, level=level))
+    contract_level = level
+
+set_contract_level(os.environ.get('CONTRACT_LEVEL', FULL))
+
+## Whether a container of the given children is left out at this level
+def disabled(cs):
+    return contract_level == OFF and all_preserving(cs)
+
+## The child a container checks at this level
+def shallow(c):
+    if contract_level != FULL and preserving(c):
+        return any_t
+    return c
+
+# Lazy module level values
+
+## A module level value built on first access instead of when the module is
+## imported. Its one public name is an attribute of the module, e.g.
+## contract.addMonoid or `from contract import addMonoid`, see LazyModule;
+## the functions of the module read it through its private accessor, e.g.
+## _addMonoid().
+class Lazy(object):
+    def __init__(self, builder):
+        self.builder = builder
+        self.built = False
+        self.value = None
+
+    def __call__(self):
+        if not self.built:
+            self.value = self.builder()
+            self.built = True
+        return self.value
+
+## The Lazy values by the names the other modules import
+lazy_values = {}
+
+## The accessor of the value of the builder, imported as name
+def lazy_value(name, builder):
+    accessor = lazy_values[name] = Lazy(builder)
+    return accessor
+
+## The module as the other modules import it: its attributes are the
+## globals of the module and the Lazy values, built on their first access.
+class LazyModule(types.ModuleType):
+    def __init__(self, module):
+        types.ModuleType.__init__(self, module.__name__, module.__doc__)
+        # the globals of the functions are cleared when their module is freed
+        self.__dict__['__wrapped__'] = module
+
+    def __getattr__(self, name):
+        namespace = self.__dict__['__wrapped__'].__dict__
+        if name == '__all__':
+            return [n for n in self.__dir__() if not n.startswith('_')]
+        if name in namespace:
+            return namespace[name]
+        if name in lazy_values:
+            return lazy_values[name]()
+        raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        setattr(self.__dict__['__wrapped__'], name, value)
+
+    def __dir__(self):
+        return sorted(set(self.__dict__['__wrapped__'].__dict__) | set(lazy_values))
+
+def contract_name(c):
+    if isinstance(c, tuple):
+        return '{k!r}: {c}'.format(k=c[0], c=contract_name(c[1]))
+    if isinstance(c, Contract):
+        return repr(c)
+    return getattr(c, '__name__', repr(c))
+
+## The message of the TypeError the contract raises for x, for the tests
+def expect_type_error(c, x):
+    try:
+        c(x)
+    except TypeError as e:
+        return str(e)
+    raise Exception("Expected TypeError for {x}".format(x=x))
+
 # A contract that checks the parameter for a given type
-def type_of(t):
-    def contract(x):
+class TypeOf(Contract):
+    __slots__ = ()
+
+    def __init__(self, t):
+        Contract.__init__(self, 'type_of', type=t)
+        self.preserving = True
+
+        self.fast = type_check(t)
+
+    def __call__(self, x):
+        if not isinstance(x, self.type):
+            raise TypeError('{type} is expected found {found}: {value}'.format(type=self.type, found=type(x), value=x))
+        return x
+
+## The check of type_of(t) as a plain function, which is called faster than
+## a contract, for the containers to map over their elements
+def type_check(t):
+    def check(x):
         if not isinstance(x, t):
             raise TypeError('{type} is expected found {found}: {value}'.format(type=t, found=type(x), value=x))
         return x
-    return contract
+    return check
+
+## The fastest callable checking as c does
+def fast(c):
+    return c.fast if isinstance(c, Contract) else c
+
+def type_of(t):
+    return intern(TypeOf(t))
 
 ## A special contract that does not checks the type of the
 ## parameter.
 def any_t(x):
     return x
 
+any_t.preserving = True
+
 ## A guarded function, expects a guarded input and returns a guarded output
 def inc(x):
     x = int_t(x)
@@ -34,7 +265,7 @@ unicode_t = type_of(unicode)
 bool_t = type_of(bool)
 int_t = type_of(int)
 object_t = type_of(object)
-func_t = type_of(types.FunctionType)
+func_t = type_of((types.FunctionType, Contract))
 
 array_t = type_of(array.array)
 list_t = type_of(list)
@@ -43,21 +274,272 @@ dict_t = type_of(dict)
 ## List functor acting on contract, if we have a morhishm as a guarded
 ## function, as the guarded function checks the input type of its elements
 ## It produces new objects and new morhisms
+class ListOf(Contract):
+    __slots__ = ('element',)
+
+    def __init__(self, c):
+        Contract.__init__(self, 'list_of', [c])
+        self.preserving = preserving(c)
+        self.element = fast(c)
+
+    def __call__(self, l):
+        return map(self.element, list_t(l))
+
+    def check(self, l):
+        c = checker(self.children[0])
+        if self.preserving:
+            for x in list_t(l):
+                c(x)
+            return l
+        return map(c, list_t(l))
+
+    ## The parts of the list for the sampled checks (see sampled)
+    def parts(self, l):
+        return list_t(l)
+
+    def check_part(self, l, parts, indices):
+        c = self.children[0]
+        for i in indices:
+            c(l[i])
+
+    def step(self, l, out, i, stack):
+        list_t(l)
+        c = self.children[0]
+        result = out[i] = [None] * len(l)
+        for j in reversed(range(len(l))):
+            stack.append((c, l[j], result, j))
+
+## The contracts are simplified as they are built, a child that accepts
+## anything is not mapped over, e.g. list_of(any_t) only checks the shape.
 def list_of(c):
-    def fmap(l):
-        return map(c,list_t(l))
-    return fmap
+    if disabled([c]):
+        return any_t
+    c = shallow(c)
+    if c is any_t:
+        return list_t
+    return intern(ListOf(c))
+
+## Streaming variant of list_of: accepts any iterable and checks its
+## elements lazily, one by one, as the result is consumed.
+class IterOf(Contract):
+    __slots__ = ('element',)
+
+    def __init__(self, c):
+        Contract.__init__(self, 'iter_of', [c])
+        self.element = fast(c)
+
+    def __call__(self, xs):
+        return itertools.imap(self.element, iter(xs))
+
+def iter_of(c):
+    return intern(IterOf(c))
+
+def iter_of_test():
+    xs = iter_of(int_t)(itertools.count())
+    print list(itertools.islice(xs, 3))
+    ys = iter_of(int_t)(x for x in [1, 2, "three"])
+    print next(ys), next(ys)
+    try:
+        next(ys)
+    except TypeError as e:
+        print e
 
 ## Dict functor acting on contract, if we have a morhism as a guarded
 ## function, as the guard function checks the input type of its value elements
-def dict_of(c):
-    def fmap(d):
+class DictOf(Contract):
+    __slots__ = ('element',)
+
+    def __init__(self, c):
+        Contract.__init__(self, 'dict_of', [c])
+        self.preserving = preserving(c)
+        self.element = fast(c)
+
+    def __call__(self, d):
         dict_t(d)
+        c = self.element
         result = {}
         for k in d:
             result[k] = c(d[k])
         return result
-    return fmap
+
+    def check(self, d):
+        dict_t(d)
+        c = checker(self.children[0])
+        if self.preserving:
+            for k in d:
+                c(d[k])
+            return d
+        result = {}
+        for k in d:
+            result[k] = c(d[k])
+        return result
+
+    def parts(self, d):
+        return list(dict_t(d))
+
+    def check_part(self, d, parts, indices):
+        c = self.children[0]
+        for i in indices:
+            c(d[parts[i]])
+
+    def step(self, d, out, i, stack):
+        dict_t(d)
+        c = self.children[0]
+        result = out[i] = {}
+        for k in reversed(list(d)):
+            stack.append((c, d[k], result, k))
+
+def dict_of(c):
+    if disabled([c]):
+        return any_t
+    c = shallow(c)
+    if c is any_t:
+        return dict_t
+    return intern(DictOf(c))
+
+## Validate only mode: list_of, dict_of and prods return the checked value
+## itself, instead of a copy, when all their children are preserving, and
+## copy only the parts where a child transforms its value.
+class ValidateOnly(Contract):
+    __slots__ = ()
+
+    def __init__(self, c):
+        Contract.__init__(self, 'validate_only', [c])
+        self.preserving = preserving(c)
+
+    def __call__(self, x):
+        return checker(self.children[0])(x)
+
+def validate_only(c):
+    return intern(ValidateOnly(c))
+
+def validate_only_test():
+    d = {'a': [1, 2], 'b': [3]}
+    print validate_only(dict_of(list_of(int_t)))(d) is d
+    x = validate_only(list_of(prods({'m': maybe(int_t), 'i': int_t})))([{'m': just(1), 'i': 2}])
+    print x[0]['m'], x[0]['i']
+    try:
+        validate_only(dict_of(list_of(int_t)))({'a': [1, 'x']})
+    except TypeError as e:
+        print e
+
+## How many parts of a container were checked by a sampled contract
+Coverage = collections.namedtuple('Coverage', ['checked', 'total'])
+
+## Sampled mode of container contracts: only a fraction or a number of
+## the parts are checked, chosen by a seeded random generator, and with
+## a budget the checks stop after that many seconds. The contract returns
+## the container itself, verify also tells how much of it was checked.
+class Sampled(Contract):
+    __slots__ = ('fraction', 'count', 'seed', 'budget')
+
+    def __init__(self, c, fraction=None, count=None, seed=None, budget=None):
+        if not (hasattr(c, 'parts') or c in (list_t, dict_t)):
+            raise TypeError("Sampling is not supported by {c}".format(c=contract_name(c)))
+        self.fraction = fraction
+        self.count = count
+        self.seed = seed
+        self.budget = budget
+        Contract.__init__(self, 'sampled', [c])
+        self.preserving = True
+
+    def key(self):
+        return Contract.key(self) + (self.fraction, self.count, self.seed, self.budget)
+
+    ## The sorted indices of the parts to check
+    def indices(self, total):
+        n = total
+        if self.count is not None:
+            n = min(n, self.count)
+        if self.fraction is not None:
+            n = min(n, int(math.ceil(self.fraction * total)))
+        if n == total:
+            return xrange(0, total)
+        import random
+        return sorted(random.Random(self.seed).sample(xrange(0, total), n))
+
+    def verify(self, x, block=256):
+        c = self.children[0]
+        if not hasattr(c, 'parts'):
+            # list_of(any_t) or dict_of(any_t), every part is accepted
+            return Coverage(len(c(x)), len(x))
+        parts = c.parts(x)
+        chosen = self.indices(len(parts))
+        if self.budget is None:
+            c.check_part(x, parts, chosen)
+            return Coverage(len(chosen), len(parts))
+        deadline = time.time() + self.budget
+        checked = 0
+        for start in xrange(0, len(chosen), block):
+            if time.time() >= deadline:
+                break
+            if isinstance(chosen, list):
+                indices = chosen[start:start + block]
+            else:
+                indices = xrange(start, min(start + block, len(chosen)))
+            c.check_part(x, parts, indices)
+            checked += len(indices)
+        return Coverage(checked, len(parts))
+
+    def __call__(self, x):
+        self.verify(x)
+        return x
+
+def sampled(c, fraction=None, count=None, seed=None, budget=None):
+    if disabled([c]):
+        return any_t
+    return intern(Sampled(c, fraction, count, seed, budget))
+
+def sampled_test():
+    xs = range(0, 1000)
+    print sampled(list_of(int_t), fraction=0.1, seed=1).verify(xs)
+    print sampled(dict_of(int_t), count=5, seed=1).verify(dict(zip(xs, xs)))
+    print sampled(list_of(int_t), budget=1.0).verify(xs)
+    print sampled(list_of(int_t), count=3, seed=1)(xs) is xs
+
+def contract_level_test():
+    f = lambda x: x + 1
+    try:
+        set_contract_level(OFF)
+        print hom(int_t, int_t)(f) is f, list_of(prods({'i': int_t})) is any_t
+        print list_of(lambda x: x * 2)([1, 2])
+        cells = ['cons', ['x', ['nil', {}]]]
+        print list_c(int_t)(cells) is cells, type_of(int) is int_t
+        set_contract_level(BOUNDARY)
+        print list_of(int_t)(['not', 'checked']), hom(list_of(int_t), int_t)(len)([1, 'x'])
+    finally:
+        set_contract_level(FULL)
+    print list_of(int_t) is not any_t
+    try:
+        hom(int_t, int_t)(f)('x')
+        raise Exception("The primitives are left off")
+    except TypeError:
+        pass
+
+def contract_structure_test():
+    c = list_of(prods({'i': int_t, 's': string_t}))
+    print c
+    print c.kind, c.children[0].kind, c.children[0].contracts()['i'].type
+    if c != list_of(prods({'s': string_t, 'i': int_t})) or hash(c) != hash(list_of(prods({'s': string_t, 'i': int_t}))):
+        raise Exception("Structurally equal contracts differ")
+    if list_of(int_t) == list_of(string_t):
+        raise Exception("Structurally different contracts are equal")
+
+def simplify_test():
+    x = object()
+    print list_of(any_t) is list_t, dict_of(any_t) is dict_t, prods({}) is empty_t
+    print maybe(any_t)(nothing), prodn([any_t, int_t])([x, 1])[0] is x
+    print twice(list_of)(any_t), sampled(list_of(any_t), count=1).verify([1, 2])
+
+def intern_test():
+    if type_of(int) is not int_t or list_of(int_t) is not list_of(type_of(int)):
+        raise Exception("Structurally equal contracts are not shared")
+    print list_c(int_t) is list_c(int_t), maybe(int_t) is maybe(int_t)
+    # the shared contracts outlive a change of the contract level
+    set_contract_level(BOUNDARY)
+    set_contract_level(FULL)
+    if type_of(int) is not int_t:
+        raise Exception("The shared contracts are dropped")
 
 # Maybe
 
@@ -88,15 +570,36 @@ just = lambda x: Just(x)
 # Maybe functor
 
 ## Functor based on the Maybe data
-def maybe(c):
-    def fmap(m):
+class MaybeOf(Contract):
+    __slots__ = ()
+
+    def __init__(self, c):
+        Contract.__init__(self, 'maybe', [c])
+
+    def __call__(self, m):
         if isinstance(m, Just):
-            return Just(c(m.x))
+            return Just(self.children[0](m.x))
         elif isinstance(m, Nothing):
             return m
         else:
             raise TypeError('Expected Nothing or Just(value)')
-    return fmap
+
+    def step(self, m, out, i, stack):
+        if isinstance(m, Just):
+            result = out[i] = Just(None)
+            stack.append((self.children[0], m.x, result.__dict__, 'x'))
+        else:
+            out[i] = self(m)
+
+def maybe(c):
+    if disabled([c]):
+        return any_t
+    c = shallow(c)
+    if c is any_t:
+        return type_of((Just, Nothing))
+    return intern(MaybeOf(c))
+
+maybe_t = maybe(any_t)
 
 ## One other morphism between contracts(object in our category)
 def repeat(s):
@@ -117,22 +620,31 @@ def maybeUnit(c):
         return once(maybe)(c)(just(x))
     return wrap
 
+## Checks and concatenates the lists in one pass, [[1], [1,4]] gives
+## [1, 1, 4]: the result is allocated once and every element is checked
+## by c once, where twice(list_of)(c) and once(list_of)(c) would both
+## check it.
 def listOfFlatten(c):
+    c = shallow(c)
     def flatten(llx):
-        llx = twice(list_of)(c)(llx) # [[1], [1,4]]
-        result = []
+        list_t(llx)
+        result = [None] * sum(len(list_t(xs)) for xs in llx)
+        i = 0
         for xs in llx:
-            result = result + xs
-        return once(list_of)(c)(result)
+            n = len(xs)
+            result[i:i + n] = xs if c is any_t else map(c, xs)
+            i += n
+        return result
     return flatten
 
 def maybeFlatten(c):
+    shape = maybe(any_t)
+    inner = maybe(c)
     def flatten(mmx):
-        mmx = twice(maybe)(c)(mmx)
-        result = mmx
+        shape(mmx)
         if isinstance(mmx, Just):
-            result = result.x
-        return once(maybe)(c)(result)
+            return inner(mmx.x)
+        return mmx
     return flatten
 
 def maybe_test():
@@ -182,25 +694,55 @@ def maybe_monad_test():
 
 ## Given a list of contracts, creates a contract for
 ## a list whose elements satisfy the respective contracts.
-def prodn(cs, multi_args_fun=False):
-    # Checks if the argument is a list of contracts
-    list_of(func_t)(cs)
-    length = len(cs)
+class ProdN(Contract):
+    __slots__ = ('multi_args_fun',)
 
-    if multi_args_fun:
-        apply_fun = lambda f, x: f(*x)
-    else:
-        apply_fun = lambda f, x: f(x)
+    def __init__(self, cs, multi_args_fun=False):
+        self.multi_args_fun = multi_args_fun
+        Contract.__init__(self, 'prodn', cs)
 
-    def apply(args):
+    def key(self):
+        return Contract.key(self) + (self.multi_args_fun,)
+
+    def __call__(self, args):
+        cs = self.children
+        length = len(cs)
         list_t(args)
         if (len(args) != length):
             raise TypeError("Expected {length} arguments".format(length=length))
         result = []
-        for i in range(0, length):
-            result.append(apply_fun(cs[i], args[i]))
+        if self.multi_args_fun:
+            for i in range(0, length):
+                result.append(cs[i](*args[i]))
+        else:
+            for i in range(0, length):
+                c = cs[i]
+                result.append(args[i] if c is any_t else c(args[i]))
         return result
-    return apply
+
+    def step(self, args, out, i, stack):
+        if self.multi_args_fun:
+            out[i] = self(args)
+            return
+        cs = self.children
+        list_t(args)
+        if (len(args) != len(cs)):
+            raise TypeError("Expected {length} arguments".format(length=len(cs)))
+        result = out[i] = [None] * len(cs)
+        # the children before the first recursive one are checked right away
+        first = 0
+        while first < len(cs) and not getattr(cs[first], 'recursive', False):
+            result[first] = cs[first](args[first])
+            first += 1
+        for j in xrange(len(cs) - 1, first - 1, -1):
+            stack.append((cs[j], args[j], result, j))
+
+def prodn(cs, multi_args_fun=False):
+    # Checks if the argument is a list of contracts
+    list_of(func_t)(cs)
+    if disabled(cs):
+        return any_t
+    return intern(ProdN(map(shallow, cs), multi_args_fun))
 
 def prodn_test():
     int_str_t = prodn([int_t, string_t])
@@ -209,19 +751,80 @@ def prodn_test():
 
 ## Given a dict of contracts, creates a contract fo
 ## a dict whose elements satisfy the respective contracts
-def prods(cs):
-    # Checks if the argument is a dict of contracts
-    dict_of(func_t)(cs)
-    length = len(cs)
-    def apply(args):
+## The children of the keyed contracts are (key, contract) pairs,
+## their structure does not depend on the order of the pairs.
+class Keyed(Contract):
+    __slots__ = ()
+
+    def key(self):
+        return (self.__class__, self.kind, frozenset(self.children))
+
+    def child_contracts(self):
+        return [c for k, c in self.children]
+
+    def contracts(self):
+        return dict(self.children)
+
+class ProdS(Keyed):
+    __slots__ = ()
+
+    def __init__(self, cs):
+        Contract.__init__(self, 'prods', cs.items())
+        self.preserving = all_preserving(self.child_contracts())
+
+    def __call__(self, args):
         dict_t(args)
-        if (len(args) != length):
-            raise TypeError("Expected {length} arguments".format(length=length))
+        if (len(args) != len(self.children)):
+            raise TypeError("Expected {length} arguments".format(length=len(self.children)))
         result = {}
-        for k in cs:
-            result[k] = cs[k](args[k])
+        for k, c in self.children:
+            result[k] = c(args[k])
         return result
-    return apply
+
+    def check(self, args):
+        dict_t(args)
+        if (len(args) != len(self.children)):
+            raise TypeError("Expected {length} arguments".format(length=len(self.children)))
+        if self.preserving:
+            for k, c in self.children:
+                checker(c)(args[k])
+            return args
+        result = {}
+        for k, c in self.children:
+            result[k] = checker(c)(args[k])
+        return result
+
+    def step(self, args, out, i, stack):
+        dict_t(args)
+        if (len(args) != len(self.children)):
+            raise TypeError("Expected {length} arguments".format(length=len(self.children)))
+        result = out[i] = {}
+        tasks = []
+        for k, c in self.children:
+            if k in args:
+                tasks.append((c, args[k], result, k))
+            else:
+                # looked up only when its turn comes, as __call__ does
+                tasks.append((lambda k, c=c: c(args[k]), k, result, k))
+        stack.extend(reversed(tasks))
+
+def prods(cs):
+    # Checks if the argument is a dict of contracts
+    dict_of(func_t)(cs)
+    if disabled(cs.values()):
+        return any_t
+    if len(cs) == 0:
+        return empty_t
+    return intern(ProdS(dict((k, shallow(c)) for k, c in cs.items())))
+
+## prods({}), the empty product, only accepts the empty dict
+def empty_t(args):
+    dict_t(args)
+    if len(args) != 0:
+        raise TypeError("Expected 0 arguments")
+    return args
+
+empty_t.preserving = True
 
 def prods_test():
     int_str_t = prods({'i': int_t, 's': string_t})
@@ -253,18 +856,36 @@ def prod_test():
 ## 2-element list where item 0 is an index and item 1
 ## is a value satisfying the contract at that index
 ## in the array
-def coprodn(cs):
-    list_of(func_t)(cs)
-    length = len(cs)
-    def apply(choice):
+class CoprodN(Contract):
+    __slots__ = ()
+
+    def __init__(self, cs):
+        Contract.__init__(self, 'coprodn', cs)
+
+    def __call__(self, choice):
         list_t(choice)
         int_t(choice[0])
         if len(choice) != 2:
             raise TypeError("Expected [int_t, any_t]")
-        if choice[0] >= length:
+        if choice[0] >= len(self.children):
             raise TypeError("Tag out of range.")
-        return [choice[0], cs[choice[0]](choice[1])]
-    return apply
+        return [choice[0], self.children[choice[0]](choice[1])]
+
+    def step(self, choice, out, i, stack):
+        list_t(choice)
+        int_t(choice[0])
+        if len(choice) != 2:
+            raise TypeError("Expected [int_t, any_t]")
+        if choice[0] >= len(self.children):
+            raise TypeError("Tag out of range.")
+        result = out[i] = [choice[0], None]
+        stack.append((self.children[choice[0]], choice[1], result, 1))
+
+def coprodn(cs):
+    list_of(func_t)(cs)
+    if disabled(cs):
+        return any_t
+    return intern(CoprodN(map(shallow, cs)))
 
 def coprodn_test():
     int_str_t = coprodn([int_t, string_t])
@@ -273,17 +894,40 @@ def coprodn_test():
     x = int_str_t([1, "hello"])
     print x
 
-def coprods(cs):
-    dict_of(func_t)(cs)
-    def apply(choice):
+class CoprodS(Keyed):
+    __slots__ = ('cs',)
+
+    def __init__(self, cs):
+        self.cs = dict(cs)
+        Contract.__init__(self, 'coprods', cs.items())
+
+    def contracts(self):
+        return self.cs
+
+    def __call__(self, choice):
         list_t(choice)
         string_t(choice[0])
         if len(choice) != 2:
             raise TypeError("Expected [string_t, any_t]")
-        if choice[0] not in cs:
+        if choice[0] not in self.cs:
             raise TypeError("Unknown tag: {tag}".format(tag=choice[0]))
-        return [choice[0], cs[choice[0]](choice[1])]
-    return apply
+        return [choice[0], self.cs[choice[0]](choice[1])]
+
+    def step(self, choice, out, i, stack):
+        list_t(choice)
+        string_t(choice[0])
+        if len(choice) != 2:
+            raise TypeError("Expected [string_t, any_t]")
+        if choice[0] not in self.cs:
+            raise TypeError("Unknown tag: {tag}".format(tag=choice[0]))
+        result = out[i] = [choice[0], None]
+        stack.append((self.cs[choice[0]], choice[1], result, 1))
+
+def coprods(cs):
+    dict_of(func_t)(cs)
+    if disabled(cs.values()):
+        return any_t
+    return intern(CoprodS(dict((k, shallow(c)) for k, c in cs.items())))
 
 def coprods_test():
     int_str_t = coprods({ 'i': int_t, 's': string_t })
@@ -367,27 +1011,445 @@ def pullback_test():
 
 ## Creates a contract for a function whose inputs and output
 ## satisfy the given contracts
+class Hom(Contract):
+    __slots__ = ('before',)
+
+    def __init__(self, arguments):
+        self.before = intern(ProdN(arguments[0:-1]))
+        Contract.__init__(self, 'hom', arguments)
+
+    def __call__(self, middle):
+        cs = self.children[0:-1]
+        after = self.children[-1]
+        if len(cs) < len(guards):
+            wrapped = guards[len(cs)](middle, after, *cs)
+        else:
+            before = self.before
+            def wrapped(*varArgs):
+                before(list(varArgs))
+                return after(middle(*varArgs))
+        # compose looks the contract up to leave out the redundant checks
+        wrapped.contract = self
+        wrapped.middle = middle
+        return wrapped
+
+    ## Adaptive guard: counts the calls and the types of their arguments and
+    ## result, once the same types are seen threshold times in a row, the
+    ## values checked by type_of are only compared to those types, and any
+    ## other type falls back to the full guard.
+    def adaptive(self, threshold=1000):
+        def guard(middle):
+            return adaptive_guard(self.children[0:-1], self.children[-1], middle, self(middle), threshold)
+        return guard
+
+    ## Memoizing guard of a pure function: the results are cached by the
+    ## arguments and their types, see LRUCache. A hit skips the function and
+    ## the output contract, and the input contracts too when they are all
+    ## preserving, as the same arguments of the same types passed them.
+    def memo(self, maxsize=128, ttl=None):
+        before = None if all_preserving(self.children[0:-1]) else self.before
+        def guard(middle):
+            return memo_guard(self(middle), before, maxsize, ttl)
+        return guard
+
+## Guarded functions specialized by the number of arguments, each argument
+## is checked right away, without building a list of the arguments.
+def guard0(middle, after):
+    def wrapped():
+        return after(middle())
+    return wrapped
+
+def guard1(middle, after, c0):
+    def wrapped(x0):
+        c0(x0)
+        return after(middle(x0))
+    return wrapped
+
+def guard2(middle, after, c0, c1):
+    def wrapped(x0, x1):
+        c0(x0)
+        c1(x1)
+        return after(middle(x0, x1))
+    return wrapped
+
+def guard3(middle, after, c0, c1, c2):
+    def wrapped(x0, x1, x2):
+        c0(x0)
+        c1(x1)
+        c2(x2)
+        return after(middle(x0, x1, x2))
+    return wrapped
+
+def guard4(middle, after, c0, c1, c2, c3):
+    def wrapped(x0, x1, x2, x3):
+        c0(x0)
+        c1(x1)
+        c2(x2)
+        c3(x3)
+        return after(middle(x0, x1, x2, x3))
+    return wrapped
+
+guards = [guard0, guard1, guard2, guard3, guard4]
+
+## Generates the adaptive guard of middle, e.g. for hom(int_t, c, int_t):
+##
+##     def wrapped(x0, x1):
+##         if type(x0) is cached[0]:
+##             c1(x1)
+##             r = middle(x0, x1)
+##             if type(r) is cached[2]:
+##                 return r
+##             return after(r)
+##         return count(x0, x1)
+##
+## The cached types are None, which is no type, until count fills them.
+def adaptive_guard(cs, after, middle, full, threshold):
+    arity = len(cs)
+    if not any(isinstance(c, TypeOf) for c in cs):
+        return full
+    cached = [None] * (arity + 1)
+    seen = [None, 0]
+    def count(*args):
+        result = full(*args)
+        observed = tuple(map(type, args)) + (type(result),)
+        if observed != seen[0]:
+            seen[0] = observed
+            seen[1] = 0
+        seen[1] += 1
+        if seen[1] >= threshold:
+            for i, t in enumerate(observed):
+                # type(x) of an old style instance does not tell its class
+                if t is not types.InstanceType:
+                    cached[i] = t
+        return result
+    namespace = {'middle': middle, 'after': after, 'count': count, 'cached': cached}
+    args = ', '.join('x{i}'.format(i=i) for i in range(0, arity))
+    tests = []
+    checks = []
+    for i, c in enumerate(cs):
+        if isinstance(c, TypeOf):
+            tests.append('type(x{i}) is cached[{i}]'.format(i=i))
+        else:
+            namespace['c{i}'.format(i=i)] = c
+            checks.append('        c{i}(x{i})\n'.format(i=i))
+    if isinstance(after, TypeOf):
+        result = ('        r = middle({args})\n'
+                  '        if type(r) is cached[{n}]:\n'
+                  '            return r\n'
+                  '        return after(r)\n').format(args=args, n=arity)
+    else:
+        result = '        return after(middle({args}))\n'.format(args=args)
+    source = ('def wrapped({args}):\n'
+              '    if {tests}:\n'
+              '{checks}'
+              '{result}'
+              '    return count({args})\n').format(args=args, tests=' and '.join(tests), checks=''.join(checks), result=result)
+    exec compile(source, '<adaptive hom>', 'exec') in namespace
+    return namespace['wrapped']
+
+## The results of a memoized function by its arguments, the least recently
+## used ones are dropped over maxsize entries, none with maxsize None, and
+## with a ttl the entries expire ttl seconds after they were computed. The
+## entries are links [previous, next, key, value, expires] of a circular
+## list in the order of their use, from root to root.
+class LRUCache(object):
+    missing = object()
+
+    def __init__(self, maxsize=128, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.links = {}
+        self.root = []
+        self.root[:] = [self.root, self.root, None, None, None]
+        self.hits = 0
+        self.misses = 0
+
+    ## The cached value or LRUCache.missing, raises TypeError when the key
+    ## can not be hashed.
+    def get(self, key):
+        link = self.links.get(key)
+        if link is None or (link[4] is not None and link[4] <= time.time()):
+            self.misses += 1
+            return LRUCache.missing
+        # moves the link to the end, as the most recently used
+        previous, following = link[0], link[1]
+        previous[1] = following
+        following[0] = previous
+        root = self.root
+        last = root[0]
+        last[1] = root[0] = link
+        link[0] = last
+        link[1] = root
+        self.hits += 1
+        return link[3]
+
+    def put(self, key, value):
+        expires = None if self.ttl is None else time.time() + self.ttl
+        old = self.links.pop(key, None)
+        if old is not None:
+            old[0][1] = old[1]
+            old[1][0] = old[0]
+        root = self.root
+        last = root[0]
+        link = [last, root, key, value, expires]
+        last[1] = root[0] = self.links[key] = link
+        if self.maxsize is not None and len(self.links) > self.maxsize:
+            oldest = root[1]
+            root[1] = oldest[1]
+            oldest[1][0] = root
+            del self.links[oldest[2]]
+
+## Caches the results of the guarded function full, on a hit the arguments
+## are only checked by before, when it is given. The arguments that can not
+## be hashed are not cached.
+## The cache key of a value: equal keys are equal values of the same types
+## all the way down, e.g. (1,) and (True,) or 0.0 and -0.0 have different
+## keys. Unhashable values have unhashable keys and are not cached.
+def memo_key(x):
+    t = type(x)
+    if t is float:
+        return (t, x, math.copysign(1, x))
+    if t is complex:
+        return (t, x, math.copysign(1, x.real), math.copysign(1, x.imag))
+    if isinstance(x, tuple):
+        return (t, tuple(map(memo_key, x)))
+    if isinstance(x, frozenset):
+        return (t, frozenset(map(memo_key, x)))
+    return (t, x)
+
+def memo_guard(full, before, maxsize, ttl):
+    cache = LRUCache(maxsize, ttl)
+    get = cache.get
+    missing = LRUCache.missing
+    def wrapped(*args):
+        key = tuple(map(memo_key, args))
+        try:
+            result = get(key)
+        except TypeError:
+            return full(*args)
+        if result is missing:
+            result = full(*args)
+            cache.put(key, result)
+        elif before is not None:
+            before(list(args))
+        return result
+    wrapped.cache = cache
+    return wrapped
+
 def hom(*arguments):
-    arguments = list(arguments)
-    before = prodn(list_of(func_t)(arguments[0:-1]))
-    after = func_t(arguments[-1])
-    def result(middle):
-        def wrapped(*varArgs):
-            before(list(varArgs))
-            return after(middle(*varArgs))
+    arguments = list_of(func_t)(list(arguments))
+    func_t(arguments[-1])
+    if contract_level == OFF:
+        return intern(Unguarded())
+    return intern(Hom(arguments))
+
+## The hom of the OFF contract level, it guards nothing: hom(...)(f) is f
+class Unguarded(Contract):
+    __slots__ = ()
+
+    def __init__(self):
+        Contract.__init__(self, 'unguarded')
+        self.preserving = True
+
+    def __call__(self, middle):
+        return middle
+
+    def adaptive(self, threshold=1000):
+        return self
+
+    def memo(self, maxsize=128, ttl=None):
+        def guard(middle):
+            return memo_guard(middle, None, maxsize, ttl)
+        return guard
+
+## Hom keyed by parameter name: the arguments of the guarded function are
+## checked by the contract of their parameter, whether they are passed
+## by position or by keyword.
+class HomS(Keyed):
+    __slots__ = ('after',)
+
+    def __init__(self, cs, after):
+        self.after = after
+        Contract.__init__(self, 'homs', cs.items())
+
+    def key(self):
+        return Keyed.key(self) + (self.after,)
+
+    def child_contracts(self):
+        return Keyed.child_contracts(self) + [self.after]
+
+    def __call__(self, middle):
+        cs = self.contracts()
+        after = self.after
+        # imported here, inspect is slower to import than the rest of the module
+        import inspect
+        spec = inspect.getargspec(middle)
+        names = spec.args
+        unknown = set(cs) - set(names)
+        if unknown and spec.keywords is None:
+            raise TypeError("Unknown parameters: {names}".format(names=sorted(unknown)))
+        positional = [cs.get(name, any_t) for name in names]
+        def wrapped(*args, **kwargs):
+            for c, x in zip(positional, args):
+                c(x)
+            for name in kwargs:
+                if name in cs:
+                    cs[name](kwargs[name])
+            return after(middle(*args, **kwargs))
         return wrapped
-    return result
+
+def homs(cs, after):
+    dict_of(func_t)(cs)
+    func_t(after)
+    if contract_level == OFF:
+        return intern(Unguarded())
+    return intern(HomS(cs, after))
+
+## Subsumption of contracts: subsumes(a, b) when every value accepted by a
+## is also accepted by b, e.g. list_of(int_t) and list_of(object_t).
+def subsumes(a, b):
+    if a == b or b is any_t:
+        return True
+    if isinstance(a, TypeOf) and isinstance(b, TypeOf):
+        ts = a.type if isinstance(a.type, tuple) else (a.type,)
+        return all(issubclass(t, b.type) for t in ts)
+    if isinstance(a, InRange) and isinstance(b, InRange):
+        return b.bounds[0] <= a.bounds[0] and a.bounds[1] <= b.bounds[1]
+    if a is bit_t and isinstance(b, InRange):
+        return b.bounds[0] <= 0 and 1 < b.bounds[1]
+    if isinstance(a, Contract) and isinstance(b, TypeOf):
+        shapes = {'list_of': list, 'prodn': list, 'coprodn': list, 'coprods': list, 'dict_of': dict, 'prods': dict}
+        return a.kind in shapes and issubclass(shapes[a.kind], b.type) and not getattr(a, 'multi_args_fun', False)
+    if not (isinstance(a, Contract) and isinstance(b, Contract)) or a.kind != b.kind:
+        return False
+    if a.kind in ('list_of', 'dict_of', 'maybe'):
+        return subsumes(a.children[0], b.children[0])
+    if a.kind == 'prodn' and not (a.multi_args_fun or b.multi_args_fun):
+        return len(a.children) == len(b.children) and all(map(subsumes, a.children, b.children))
+    if a.kind == 'prods':
+        bs = b.contracts()
+        return len(a.children) == len(bs) and all(k in bs and subsumes(c, bs[k]) for k, c in a.children)
+    return False
+
+## The input check of a stage can be left out when the output contract of
+## the stage before it already accepted the value. A contract that is not
+## preserving is never dropped, even the same one: hom leaves out the value
+## its input check returns, so it checks the value the stage gets.
+def redundant(after, before):
+    return preserving(before) and subsumes(after, before)
+
+## The guarded function without its input checks, only the output is checked
+def unchecked(guarded):
+    after = guarded.contract.children[-1]
+    middle = guarded.middle
+    def wrapped(*args):
+        return after(middle(*args))
+    return wrapped
+
+def pipe(first, rest):
+    def pipeline(*args):
+        x = first(*args)
+        for f in rest:
+            x = f(x)
+        return x
+    return pipeline
+
+## Composes guarded functions into a pipeline, compose(f, g, h)(x) is
+## h(g(f(x))). The input check of every stage whose hom input is covered by
+## the output contract of the stage before it is left out, the output
+## checks are all kept. Other functions are called as they are.
+def compose(*stages):
+    stages = list_of(func_t)(list(stages))
+    if len(stages) == 0:
+        return any_t
+    rest = []
+    for previous, stage in zip(stages, stages[1:]):
+        contract = getattr(stage, 'contract', None)
+        after = getattr(previous, 'contract', None)
+        if (isinstance(contract, Hom) and isinstance(after, Hom) and len(contract.children) == 2
+                and redundant(after.children[-1], contract.children[0])):
+            rest.append(unchecked(stage))
+        else:
+            rest.append(stage)
+    pipeline = pipe(stages[0], rest)
+    head = getattr(stages[0], 'contract', None)
+    last = getattr(stages[-1], 'contract', None)
+    if isinstance(head, Hom) and isinstance(last, Hom):
+        # the pipeline is a guarded function itself, it composes further
+        pipeline.contract = intern(Hom(head.children[0:-1] + last.children[-1:]))
+        pipeline.middle = pipe(unchecked(stages[0]), rest)
+    return pipeline
 
 def repeat_i(i):
     print i
     return "{x}{x}".format(x=i)
 
-repeat_h = hom(int_t, string_t)(repeat_i)
+_repeat_h = lazy_value('repeat_h', lambda: hom(int_t, string_t)(repeat_i))
 
 def hom_test():
-    x = repeat_h(3)
+    x = _repeat_h()(3)
     print x
 
+def adaptive_hom_test():
+    double = hom(int_t, string_t, string_t).adaptive(threshold=10)(lambda n, s: s * n)
+    for i in range(0, 20):
+        double(2, 'ab')
+    print double(2, 'ab'), double(True, 'ab')
+    try:
+        double('2', 'ab')
+    except TypeError as e:
+        print e
+
+def memo_hom_test():
+    calls = []
+    def square(x):
+        calls.append(x)
+        return x * x
+    f = hom(int_t, int_t).memo(maxsize=2)(square)
+    print f(2), f(2), f(3), f(4), f(2), len(calls), f.cache.hits
+    g = hom(int_t, string_t).memo()(repr)
+    print g(1), g(True), hom(int_t, int_t).memo(ttl=0)(square)(5), len(calls)
+    try:
+        f('2')
+    except TypeError as e:
+        print e
+    print hom(list_t, int_t).memo()(len)([1, 2])
+    # equal values of different types or signs are cached apart
+    r = hom(any_t, string_t).memo()(repr)
+    print r((1,)), r((True,)), r(frozenset([1])), r(frozenset([True]))
+    sign = hom(type_of(float), type_of(float)).memo()(lambda x: math.copysign(1, x))
+    print sign(0.0), sign(-0.0)
+
+def homs_test():
+    greet = homs({'name': string_t, 'times': int_t}, string_t)(lambda name, times=1: name * times)
+    print greet('ab'), greet('ab', times=2), greet(times=3, name='c')
+    try:
+        greet('ab', times='2')
+    except TypeError as e:
+        print e
+
+def compose_test():
+    checks = []
+    def counted(x):
+        checks.append(x)
+        return int_t(x)
+    counted.preserving = True
+    succ = hom(counted, counted)(lambda x: x + 1)
+    print compose(succ, succ, succ)(0), len(checks)
+    show = compose(parity, hom(in_range(0, 2), string_t)(str))
+    print repr(show(3)), subsumes(list_of(bit_t), list_of(in_range(0, 10)))
+    try:
+        compose(hom(int_t, string_t)(str), hom(int_t, int_t)(abs))(1)
+    except TypeError as e:
+        print e
+    # a contract changing the value is checked again, as g(f(x)) checks it
+    changing = prodn([upTo])
+    try:
+        compose(hom(int_t, changing)(lambda x: [x]), hom(changing, int_t)(len))(3)
+        raise Exception("The input check of a changing contract is left out")
+    except TypeError:
+        pass
+
 # Monoid
 
 def monoid(set, times, ident):
@@ -419,21 +1481,21 @@ def monoid_right_identity_law(mon, a):
     if mon['*'](a, mon['1']) != a:
         raise Exception("Not a right identity")
 
-concat = monoid(
+_concat = lazy_value('concat', lambda: monoid(
     string_t,
     lambda x, y: x + y,
     lambda: ""
-    )
+    ))
 
 def str_monoid_test():
-    x = concat['*']("Hello ", "World")
+    x = _concat()['*']("Hello ", "World")
     print x
 
-addition = monoid(
+_addition = lazy_value('addition', lambda: monoid(
     int_t,
     lambda x, y: x + y,
     lambda: 0
-    )
+    ))
 
 # Monads as monoids
 
@@ -513,6 +1575,36 @@ def unit(monad):
 def maybeMonad(t):
     return monad(maybe, maybeFlatten, maybeUnit)(t)
 
+# Lazy list monad
+
+## The list monad on iterators: unit, map and flatten return iterators,
+## the elements are computed, and checked by t, only as they are consumed.
+def lazyListUnit(c):
+    def wrap(x):
+        return iter([c(x)])
+    return wrap
+
+def lazyListFlatten(c):
+    def flatten(iix):
+        return iter_of(c)(itertools.chain.from_iterable(iix))
+    return flatten
+
+def lazyListMonad(t):
+    return monad(iter_of, lazyListFlatten, lazyListUnit)(t)
+
+def lazyListMonad_test():
+    bind = flat_map(lazyListMonad(int_t))
+    pairs = bind(xrange(0, 10 ** 9), lambda x:
+            bind(xrange(0, 10 ** 9), lambda y:
+                unit(lazyListMonad(any_t))(x * y)))
+    print list(itertools.islice(pairs, 0, 5))
+    monad = lazyListMonad(any_t)
+    print list(monad['*']([[1], iter([2, 3])])), list(monad['1'](5))
+    try:
+        list(bind(['a'], lambda x: [x]))
+    except TypeError as e:
+        print e
+
 # UpTo Example
 
 def upTo(x):
@@ -550,17 +1642,43 @@ def bit_t(b):
     else:
         raise TypeError('Expected a bit found {found}'.format(found=b))
 
+bit_t.preserving = True
+
+## Contract for the values lo <= x < hi
+class InRange(Contract):
+    __slots__ = ('bounds',)
+
+    def __init__(self, lo, hi):
+        self.bounds = (lo, hi)
+        Contract.__init__(self, 'in_range')
+        self.preserving = True
+
+    def key(self):
+        return Contract.key(self) + (self.bounds,)
+
+    def __repr__(self):
+        return 'in_range({lo!r}, {hi!r})'.format(lo=self.bounds[0], hi=self.bounds[1])
+
+    def __call__(self, x):
+        lo, hi = self.bounds
+        if not lo <= x < hi:
+            raise TypeError('Expected a value in [{lo}, {hi}) found {found}'.format(lo=lo, hi=hi, found=x))
+        return x
+
+def in_range(lo, hi):
+    return intern(InRange(lo, hi))
+
 # Constant Functor
 K = hom(any_t, hom(any_t))(lambda x: lambda: x)
 
 xor = hom(bit_t, bit_t, bit_t)(lambda x, y: bool(x) != bool(y))
-xorMonoid = monoid(bit_t, xor, K(0))
+_xorMonoid = lazy_value('xorMonoid', lambda: monoid(bit_t, xor, K(0)))
 
 add = hom(int_t, int_t, int_t)(lambda x, y: x + y)
-addMonoid = monoid(int_t, add, K(0))
+_addMonoid = lazy_value('addMonoid', lambda: monoid(int_t, add, K(0)))
 
 mul = hom(int_t, int_t, int_t)(lambda x, y: x * y)
-mulMonoid = monoid(int_t, mul, K(1))
+_mulMonoid = lazy_value('mulMonoid', lambda: monoid(int_t, mul, K(1)))
 
 # Monoidal homomorhism
 parity = hom(int_t, bit_t)(lambda x: x % 2)
@@ -581,13 +1699,13 @@ def monFunc(m1, m2, f):
 
 def eq_test():
     e = equalizer([
-        lambda: parity(addMonoid['1']()),
-        xorMonoid['1']
+        lambda: parity(_addMonoid()['1']()),
+        _xorMonoid()['1']
     ], multi_args_fun=True)
     print e([])
 
 def monFunc_test():
-    m = monFunc(addMonoid, xorMonoid, parity)
+    m = monFunc(_addMonoid(), _xorMonoid(), parity)
     print m['1']
     print m['*'](1, 1)
 
@@ -663,8 +1781,8 @@ def category(c, cHom):
         'cHom': cHom
     })
 
-LEQ = category(leq, leqHom)
-DIV = category(div, divHom)
+_LEQ = lazy_value('LEQ', lambda: category(leq, leqHom))
+_DIV = lazy_value('DIV', lambda: category(div, divHom))
 
 def guardFunc(triple):
     return prodn([func_t, func_t, hom(triple[0], triple[1])])(triple)
@@ -672,14 +1790,15 @@ def guardFunc(triple):
 def guardHom(before, after):
     before = guardFunc(before)
     after = guardFunc(after)
-    def compose(mmiddle):
+    def composite(middle):
         middle = guardFunc(middle)
+        pipeline = compose(before[2], middle[2], after[2])
         def f(x):
-            return [before[0], after[1], after[2](middle[2](before[2](x)))]
+            return [before[0], after[1], pipeline(x)]
         return f
-    return compose
+    return composite
 
-GUARD = category(guardFunc, guardHom)
+_GUARD = lazy_value('GUARD', lambda: category(guardFunc, guardHom))
 
 def mon(triple):
     src = prods({
@@ -698,14 +1817,15 @@ def mon(triple):
 def monHom(before, after):
     before = mon(before)
     after = mon(after)
-    def compose(mmiddle):
+    def composite(middle):
         middle = mon(middle)
+        pipeline = compose(before[2], middle[2], after[2])
         def f(x):
-            return [before[0], after[1], after[2](middle[2](before[2](x)))]
+            return [before[0], after[1], pipeline(x)]
         return f
-    return compose
+    return composite
 
-MON = category(mon, monHom)
+_MON = lazy_value('MON', lambda: category(mon, monHom))
 
 def addHom(before, after):
     int_t(before)
@@ -715,7 +1835,7 @@ def addHom(before, after):
         return after + middle + before
     return compose
 
-ADD = category(int_t, addHom)
+_ADD = lazy_value('ADD', lambda: category(int_t, addHom))
 
 def mulHom(before, after):
     int_t(before)
@@ -725,7 +1845,7 @@ def mulHom(before, after):
         return after * middle * before
     return compose
 
-MUL = category(int_t, mulHom)
+_MUL = lazy_value('MUL', lambda: category(int_t, mulHom))
 
 def fromMonoid(m):
     def compose(before, after):
@@ -757,6 +1877,79 @@ def lazyPhi(lazyProd):
 
 # list_d(x) = maybe((x, list_d(x)))
 
+## A recursive contract refers to itself through the contract fix passes
+## to its builder, the knot is tied once, when the contract is built.
+class Fix(Contract):
+    __slots__ = ('name', 'identity')
+
+    def __init__(self, name):
+        self.name = name
+        self.identity = False
+        Contract.__init__(self, 'fix')
+        self.recursive = True
+
+    ## A recursive contract is only equal to itself
+    def key(self):
+        return (self.__class__, id(self))
+
+    def tie(self, body):
+        self.children = (body,)
+
+    def __repr__(self):
+        return 'fix({name})'.format(name=self.name)
+
+    def __call__(self, x):
+        if self.identity:
+            return x
+        return run(self, x)
+
+    def step(self, x, out, i, stack):
+        body = self.children[0]
+        if getattr(body, 'recursive', False):
+            body.step(x, out, i, stack)
+        else:
+            out[i] = body(x)
+
+## Evaluates a contract with an explicit work stack instead of python
+## frames, so the depth of a recursive value is not limited by the
+## recursion limit. The children of the contracts are checked in the
+## same order as the nested calls would check them.
+##
+## When a knot and an algebra are given, every value checked by the knot
+## is folded: the algebra is applied to the checked layer once all the
+## recursive positions within it are folded (see cata).
+def run(c, x, knot=None, alg=None):
+    top = [None]
+    stack = [(c, x, top, 0)]
+    pop = stack.pop
+    layer = lambda holder: alg(holder[0])
+    while stack:
+        c, x, out, i = pop()
+        if c is knot:
+            holder = [None]
+            stack.append((layer, holder, out, i))
+            c.step(x, holder, 0, stack)
+        elif getattr(c, 'recursive', False):
+            c.step(x, out, i, stack)
+        else:
+            out[i] = c(x)
+    return top[0]
+
+## fix(lambda self: coprods({'nil': prods({}), 'cons': prodn([int_t, self])}))
+## is the contract of the lists of integers.
+##
+## With the contracts off, a recursive contract that only checks returns
+## its value: the body is built once more around a preserving knot, and
+## is left out when all of it is. The knot keeps its body for cata.
+def fix(builder):
+    knot = Fix(builder.__name__)
+    knot.tie(builder(knot))
+    if contract_level == OFF:
+        probe = Fix(builder.__name__)
+        probe.preserving = True
+        knot.identity = knot.preserving = builder(probe) is any_t
+    return knot
+
 #def list_d(c):
 #    return coprods({
 #        'nil':  prodn([]),
@@ -766,14 +1959,15 @@ def lazyPhi(lazyProd):
 # recursively and the thing is going fill up the stack
 # infinitely
 
+@interned
 def list_d(c):
-    return coprods({
+    return fix(lambda list_d_c: coprods({
         'nil': prodn([]),
         'cons': prodn([
             c,
-            lambda tail: list_d(c)(tail)
+            list_d_c
         ])
-    })
+    }))
 
 def list_d_test():
     x = list_d(int_t)(['nil', []])
@@ -783,14 +1977,30 @@ def list_d_test():
     x = list_d(int_t)(['cons', [2, ['cons', [1, ['nil', []]]]]])
     print x
 
+@interned
 def stream(c):
-    return coprods({
+    return fix(lambda stream_c: coprods({
         'nil': prodn([]),
         'cons': prodn([
             c,
-            lambda tail: lazy(stream(c))(tail)
+            lazy(stream_c)
         ])
-    })
+    }))
+
+def deep_list_test():
+    l = ['nil', {}]
+    for i in range(0, 100000):
+        l = ['cons', [i, l]]
+    x = list_c(int_t)(l)
+    print x[1][0], x[1][1][1][0]
+    try:
+        list_c(int_t)(['cons', [1, ['cons', ['x', ['nil', {}]]]]])
+    except TypeError as e:
+        print e
+    t = ['leaf', 0]
+    for i in range(0, 100000):
+        t = ['node', [t, ['leaf', i]]]
+    print tree(int_t)(t)[1][1]
 
 def stream_test():
     stm = stream(int_t)(['cons', [1, K(['nil', []])]])
@@ -841,17 +2051,32 @@ def algebra(F):
         return hom(F(c), c)
     return curry
 
+## Catamorphism: the algebra only handles one layer of the recursive
+## contract F(c), the recursive positions in the layer are already folded.
+## Checking and folding are done in one iterative pass, so values of any
+## depth can be folded, e.g. for list_c the algebra gets either
+## ['nil', {}] or ['cons', [head, folded_tail]].
+def cata(F):
+    def curry(c):
+        knot = F(c)
+        def guard(alg):
+            def folded(x):
+                return c(run(knot, x, knot, alg))
+            return folded
+        return guard
+    return curry
+
 def maybe_alg_f(mint):
     if mint[0] == 'none':
         return 0
     else:
         return mint[1]
 
-maybe_alg = algebra(maybe_c)(int_t)(maybe_alg_f)
+_maybe_alg = lazy_value('maybe_alg', lambda: algebra(maybe_c)(int_t)(maybe_alg_f))
 
 def maybe_alg_test():
-    print maybe_alg(['some', 78])
-    print maybe_alg(['none', {}])
+    print _maybe_alg()(['some', 78])
+    print _maybe_alg()(['none', {}])
 
 def getOrElse(default):
     def maybe_alg_f(mint):
@@ -865,66 +2090,83 @@ def getOrElseTest():
     print getOrElse(15)(['some', 78])
     print getOrElse(15)(['none', {}])
 
+@interned
 def list_c(c):
-    return coprods({
+    return fix(lambda list_c_c: coprods({
         'nil': prods({}),
         'cons': prodn([
             c,
-            lambda tail: list_c(c)(tail)
+            list_c_c
         ])
-    })
+    }))
 
 list_alg = algebra(list_c)
 
+list_cata = cata(list_c)
+
 def list_alg_sum_f(lint):
     if lint[0] == 'nil':
         return 1
     else:
         return lint[1][0] * list_alg_sum_f(lint[1][1])
 
-list_alg_sum = hom(list_c(int_t), int_t)(list_alg_sum_f)
+## The algebra of list_alg_sum_f on one layer, the tail is already folded
+def list_alg_sum_layer(lint):
+    if lint[0] == 'nil':
+        return 1
+    else:
+        return lint[1][0] * lint[1][1]
+
+_list_alg_sum = lazy_value('list_alg_sum', lambda: list_cata(int_t)(list_alg_sum_layer))
 
 def list_alg_sum_test():
     x = ['cons', [5, ['cons', [6, ['nil', {}]]]]]
-    print list_alg_sum(x)
+    print _list_alg_sum()(x)
+    if list_alg_sum_f(x) != _list_alg_sum()(x):
+        raise Exception("The catamorphism differs from the recursive fold")
 
 def list_alg_monoid(m):
     def alg(lm):
         if lm[0] == 'nil':
             return m['1']()
         else:
-            return m['*'](lm[1][0], alg(lm[1][1]))
-    return hom(list_c(m['t']), m['t'])(alg)
+            return m['*'](lm[1][0], lm[1][1])
+    return list_cata(m['t'])(alg)
 
 def list_alg_monoid_test():
     l = ['cons', [5, ['cons', [6, ['nil', {}]]]]]
-    print list_alg_monoid(addMonoid)(l)
-    print list_alg_monoid(mulMonoid)(l)
+    print list_alg_monoid(_addMonoid())(l)
+    print list_alg_monoid(_mulMonoid())(l)
 
+def deep_list_alg_monoid_test():
+    l = ['nil', {}]
+    for i in range(0, 100000):
+        l = ['cons', [i, l]]
+    print list_alg_monoid(_addMonoid())(l)
 
 
+@interned
 def tree(c):
-    def subtree(branch):
-        return tree(c)(branch)
-    return coprods({
+    return fix(lambda subtree: coprods({
         'leaf': c,
         'node': prodn([subtree, subtree])
-    })
+    }))
 
 tree_alg = algebra(tree)
+tree_cata = cata(tree)
 
 def tree_alg_monoid(m):
     def alg(tm):
         if tm[0] == 'leaf':
             return tm[1]
         else:
-            return m['*'](alg(tm[1][0]), alg(tm[1][1]))
-    return tree_alg(m['t'])(alg)
+            return m['*'](tm[1][0], tm[1][1])
+    return tree_cata(m['t'])(alg)
 
 def tree_algebra_monoid_test():
     t = ['node', [ ['leaf', 3], ['leaf', 4]]]
-    print tree_alg_monoid(addMonoid)(t)
-    print tree_alg_monoid(mulMonoid)(t)
+    print tree_alg_monoid(_addMonoid())(t)
+    print tree_alg_monoid(_mulMonoid())(t)
 
 ## NOTE 'for' loops are algebras on Natural numbers as Natural number is a coproduct 1 -> N <- N
 ## NOTE idea 'while' loops are related to co-natural numbers, composing a stream basically
@@ -952,14 +2194,12 @@ def try_unit(c):
     return wrap
 
 def try_flatten(c):
+    fmap = try_functor(c)
     def flatten(eex):
-        eex = twice(try_functor)(c)(eex)
-        result = None
+        try_of(eex)
         if eex[0] == 'left':
-            result = eex
-        else:
-            result = eex[1]
-        return once(try_functor)(c)(result)
+            return eex
+        return fmap(eex[1])
     return flatten
 
 def try_monad(t):
@@ -971,6 +2211,116 @@ def try_error(msg):
 def try_ok(x):
     return try_of(['right', x])
 
+# Chains of binds
+
+## A chain of binds collected before it is run, like the free monad or
+## the codensity monad in Haskell. chain(monad, m).bind(f).bind(g).run()
+## is flat_map(monad)(flat_map(monad)(m, f), g), but reassociated by the
+## runner of the monad, as m >>= (lambda x: f(x) >>= g), without checking
+## the intermediate values with monad['*']. The value of each continuation
+## is checked by the result contract of monad['*'], e.g. list_of(t), as
+## flat_map checks it.
+class Chain(object):
+    def __init__(self, monad, m, previous=None, k=None):
+        self.monad = monad
+        self.m = m
+        self.previous = previous
+        self.k = k
+
+    def bind(self, k):
+        return Chain(self.monad, self.m, self, func_t(k))
+
+    def binds(self):
+        ks = []
+        c = self
+        while c.previous is not None:
+            ks.append(c.k)
+            c = c.previous
+        ks.reverse()
+        return ks
+
+    def run(self):
+        runner = bind_runners.get(self.monad['t'])
+        if runner is None:
+            ks = [lambda x, k=k: bound(k(x)) for k in self.binds()]
+            return reduce(flat_map(self.monad), ks, bound(self.m))
+        return runner(result_contract(self.monad), self.m, self.binds())
+
+def chain(monad, m):
+    return Chain(monad, m)
+
+## The value of a continuation, which may return a chain itself
+def bound(x):
+    if isinstance(x, Chain):
+        return x.run()
+    return x
+
+## The contract of the values of the monad, e.g. list_of(t) of listMonad(t),
+## or the functor of any_t when the hom of monad['*'] is left out as the
+## contracts are off
+def result_contract(monad):
+    hom = getattr(monad['*'], 'contract', None)
+    return monad['t'](any_t) if hom is None else hom.children[-1]
+
+## Runs the binds one after the other, each of them in one pass over the
+## values, extending the list of the next values. By the associative law
+## this is the result of the right associated chain, in the same order.
+def run_list_binds(c, m, ks):
+    xs = list_t(bound(m))
+    for k in ks:
+        result = []
+        extend = result.extend
+        for x in xs:
+            extend(c(bound(k(x))))
+        xs = result
+    return xs
+
+def run_maybe_binds(c, m, ks):
+    m = maybe(any_t)(bound(m))
+    for k in ks:
+        if not isinstance(m, Just):
+            return m
+        m = c(bound(k(m.x)))
+    return m
+
+def run_try_binds(c, m, ks):
+    m = try_of(bound(m))
+    for k in ks:
+        if m[0] == 'left':
+            return m
+        m = c(bound(k(m[1])))
+    return m
+
+## The lazy list runner, nothing is computed until the result is consumed
+def run_iter_binds(c, m, ks):
+    xs = iter(bound(m))
+    for k in ks:
+        xs = itertools.chain.from_iterable(itertools.imap(lambda x, k=k: c(bound(k(x))), xs))
+    return xs
+
+bind_runners = {list_of: run_list_binds, maybe: run_maybe_binds, try_functor: run_try_binds,
+                iter_of: run_iter_binds}
+
+def chain_test():
+    step = lambda x: [x, x + 1]
+    nested = reduce(flat_map(listMonad(any_t)), [upTo, step, step], range(0, 5))
+    print chain(listMonad(any_t), range(0, 5)).bind(upTo).bind(step).bind(step).run() == nested
+    half = lambda x: just(x / 2) if x % 2 == 0 else nothing
+    print chain(maybeMonad(any_t), just(8)).bind(half).bind(half).run(), \
+        chain(maybeMonad(any_t), just(8)).bind(half).bind(half).bind(half).bind(half).run()
+    print chain(try_monad(any_t), try_ok(4)).bind(lambda x: try_ok(x - 4)).bind(lambda x: try_error('zero') if x == 0 else try_ok(1 / x)).run()
+    print chain(listMonad(any_t), [1]).bind(lambda x: chain(listMonad(any_t), [x]).bind(step)).run()
+    print list(itertools.islice(chain(lazyListMonad(any_t), itertools.count()).bind(step).bind(step).run(), 0, 5))
+    # the values of the continuations are checked as flat_map checks them
+    for monad, m, k in [(listMonad(int_t), [1], lambda x: ['a']),
+                        (maybeMonad(int_t), just(1), lambda x: just('a')),
+                        (try_monad(int_t), try_ok(1), lambda x: try_ok('a'))]:
+        try:
+            chain(monad, m).bind(k).run()
+            raise Exception("The value of the continuation is not checked")
+        except TypeError:
+            pass
+
 def try_monad_test():
     monad = try_monad(any_t)
     monad_law_one(monad, ['left', 'error_msg'])
@@ -985,6 +2335,13 @@ def try_monad_test():
 
 
 def main():
+    contract_structure_test()
+    intern_test()
+    simplify_test()
+    iter_of_test()
+    validate_only_test()
+    sampled_test()
+    contract_level_test()
     maybe_test()
     listOfFlatten_test()
     maybeFlatten_test()
@@ -995,24 +2352,34 @@ def main():
     coprods_test()
     maybe_c_test()
     hom_test()
+    homs_test()
+    compose_test()
+    adaptive_hom_test()
+    memo_hom_test()
     str_monoid_test()
     listMonad_test()
     leq_test()
     div_test()
     list_d_test()
     stream_test()
+    deep_list_test()
     prod_test()
     maybe_alg_test()
     getOrElseTest()
     list_alg_sum_test()
     list_alg_monoid_test()
+    deep_list_alg_monoid_test()
     tree_algebra_monoid_test()
     coprod_obj_test()
     pullback_test()
     monFunc_test()
     list_monad_law_test()
     flat_map_test()
+    lazyListMonad_test()
     try_monad_test()
+    chain_test()
+
+sys.modules[__name__] = LazyModule(sys.modules[__name__])
 
 if __name__ == "__main__":
     main()
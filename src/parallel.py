@@ -0,0 +1,106 @@
+"""
+Folds large inputs with a monoid on every core.
+
+As the product of a monoid is associative, the input can be split into
+chunks, each chunk folded in its own process, and the partial results
+combined with the product of the monoid again:
+
+    parallel_fold(addMonoid, range(0, 10 ** 7), workers=4)
+
+The chunks keep their order, so the monoid does not have to be
+commutative.
+"""
+
+import itertools
+import multiprocessing
+import random
+
+from contract import monoid_associative_law, list_t, int_t, addMonoid, mulMonoid, concat
+
+## The folds in progress, by token: the monoid and the data. The workers
+## inherit them when they are forked, as the guarded functions of a monoid
+## can not be pickled, and pickling the data to send it to the workers
+## would cost about as much as folding it.
+folds = {}
+tokens = itertools.count()
+
+## Folds the chunks of the data between the given bounds in a worker, and
+## sends the partial results, or the error, back to the parent.
+def fold_chunks(token, bounds, connection):
+    try:
+        mon, data = folds[token]
+        connection.send((None, [fold(mon, data[start:stop]) for start, stop in bounds]))
+    except Exception as e:
+        connection.send((e, None))
+    finally:
+        connection.close()
+
+## Folds the elements one by one, starting from the identity
+def fold(mon, xs):
+    times = mon['*']
+    result = mon['1']()
+    for x in xs:
+        result = times(result, x)
+    return result
+
+## Checks the associative law of the monoid on randomly chosen elements
+## of the input, the same seed checks the same elements.
+def check_associative(mon, data, samples, seed=None):
+    if len(data) == 0:
+        return
+    rnd = random.Random(seed)
+    for i in range(0, samples):
+        a, b, c = [data[rnd.randrange(len(data))] for j in range(0, 3)]
+        monoid_associative_law(mon, a, b, c)
+
+## Folds the data with the monoid in worker processes, each of them folds
+## its chunks of the data: only the bounds of the chunks and the partial
+## results are sent between the processes. With samples > 0 the associative
+## law is spot checked on that many triples of the data first.
+def parallel_fold(mon, data, workers=None, chunksize=None, samples=0, seed=None):
+    data = list_t(data)
+    workers = int_t(workers or multiprocessing.cpu_count())
+    check_associative(mon, data, samples, seed)
+    if workers < 2 or len(data) < 2:
+        return fold(mon, data)
+    if chunksize is None:
+        chunksize = -(-len(data) // workers)
+    bounds = [(i, i + chunksize) for i in range(0, len(data), chunksize)]
+    workers = min(workers, len(bounds))
+    token = next(tokens)
+    folds[token] = (mon, data)
+    try:
+        # the workers are forked for each fold, as that is how they get the
+        # data; worker w folds the chunks w, w + workers, ...
+        processes = []
+        for w in range(0, workers):
+            receive, send = multiprocessing.Pipe(False)
+            process = multiprocessing.Process(target=fold_chunks, args=(token, bounds[w::workers], send))
+            process.start()
+            send.close()
+            processes.append((process, receive))
+        replies = [receive.recv() for process, receive in processes]
+        for process, receive in processes:
+            process.join()
+    finally:
+        del folds[token]
+    partials = [None] * len(bounds)
+    for w, (error, results) in enumerate(replies):
+        if error is not None:
+            raise error
+        partials[w::workers] = results
+    return fold(mon, partials)
+
+def parallel_fold_test():
+    xs = range(0, 100000)
+    print parallel_fold(addMonoid, xs, workers=4, samples=10, seed=0)
+    if parallel_fold(addMonoid, xs, workers=4) != sum(xs):
+        raise Exception("Parallel fold differs from the sequential one")
+    print parallel_fold(mulMonoid, range(1, 10), workers=3)
+    print parallel_fold(concat, list("monoid"), workers=2)
+
+def main():
+    parallel_fold_test()
+
+if __name__ == "__main__":
+    main()
@@ -16,10 +16,10 @@ Not supported:
 http://code.activestate.com/recipes/578353-code-to-source-and-back/
 """
 
-import ast, inspect, re
-import astdump
+import ast, copy, hashlib, imp, inspect, marshal, os, re, sys
 from types import CodeType as code, FunctionType as function
-from contract import any_t
+import contract
+from contract import any_t, listMonad, lazyListMonad, maybeMonad, try_monad
 import inspect
 
 import __future__
@@ -34,8 +34,46 @@ class Unsupported(Error):
 class NoSource(Error):
     pass
 
-def uncompile(c):
-    """ uncompile(codeobj) -> [source, filename, mode, flags, firstlineno, privateprefix] """
+class ModuleIndex(object):
+    """ The source of a module, read once and parsed once, the first time one of its
+        functions is looked up. The functions are indexed by (name, first line). The
+        parsed nodes stay untouched, each lookup gets a copy, as the converters change
+        it in place. """
+
+    def __init__(self, filename, mtime):
+        self.filename = filename
+        self.mtime = mtime
+        with open(filename, 'rU') as f:
+            self.source = f.read()
+        self.lines = self.source.splitlines(True)
+        self.digest = hashlib.sha1(self.source).hexdigest()
+        self.functions = None
+
+    def function(self, name, firstlineno):
+        if self.functions is None:
+            self.functions = {}
+            for node in ast.walk(ast.parse(self.source, self.filename)):
+                if isinstance(node, ast.FunctionDef):
+                    self.functions[(node.name, node.lineno)] = node
+        node = self.functions.get((name, firstlineno))
+        if node is None:
+            raise NoSource('function {name} not found at line {line}'.format(name=name, line=firstlineno))
+        return copy.deepcopy(node)
+
+module_indexes = {}
+
+def module_index(filename):
+    """ The index of the source file, read again when its mtime has changed """
+    try:
+        mtime = os.stat(filename).st_mtime
+    except OSError:
+        raise NoSource('source code not available')
+    index = module_indexes.get(filename)
+    if index is None or index.mtime != mtime:
+        index = module_indexes[filename] = ModuleIndex(filename, mtime)
+    return index
+
+def check_supported(c):
     if c.co_flags & inspect.CO_NESTED or c.co_freevars:
         raise Unsupported('nested functions not supported')
     if c.co_name == '<lambda>':
@@ -43,22 +81,32 @@ def uncompile(c):
     if c.co_filename == '<string>':
         raise Unsupported('code without source file not supported')
 
-    filename = inspect.getfile(c)
-    try:
-        lines, firstlineno = inspect.getsourcelines(c)
-    except IOError:
-        raise NoSource('source code not available')
-    source = ''.join(lines)
-
+def private_prefix(c):
     # __X is mangled to _ClassName__X in methods. Find this prefix:
-    privateprefix = None
     for name in c.co_names:
         m = re.match('^(_[A-Za-z][A-Za-z0-9_]*)__.*$', name)
         if m:
-            privateprefix = m.group(1)
-            break
+            return m.group(1)
+    return None
+
+def uncompile(c):
+    """ uncompile(codeobj) -> [source, filename, mode, flags, firstlineno, privateprefix] """
+    check_supported(c)
+    filename = inspect.getfile(c)
+    firstlineno = c.co_firstlineno
+    lines = inspect.getblock(module_index(filename).lines[firstlineno - 1:])
+    source = ''.join(lines)
+    return [source, filename, 'exec', c.co_flags & PyCF_MASK, firstlineno, private_prefix(c)]
 
-    return [source, filename, 'exec', c.co_flags & PyCF_MASK, firstlineno, privateprefix]
+def uncompile_tree(c):
+    """ uncompile_tree(codeobj) -> [tree, filename, mode, flags, firstlineno, privateprefix]
+        as uncompile, but the source is a module ast of the function node of the module
+        index, so it is not parsed again """
+    check_supported(c)
+    filename = inspect.getfile(c)
+    node = module_index(filename).function(c.co_name, c.co_firstlineno)
+    tree = ast.Module(body=[node])
+    return [tree, filename, 'exec', c.co_flags & PyCF_MASK, c.co_firstlineno, private_prefix(c)]
 
 def recompile(source, filename, mode, flags=0, firstlineno=1, privateprefix=None):
     """ recompile output of uncompile back to a code object. source may also be preparsed AST """
@@ -108,52 +156,145 @@ def parse_snippet(source, filename, mode, flags, firstlineno, privateprefix_igno
     ast.increment_lineno(a, firstlineno - 2)
     return a
 
-def monadic_comp(monad):
+def monadic_comp(monad, specialize=True):
     """ Decorator that creates helper functions within the function body and transforms
-        all the list comprehension into a monadic expression """
-    module_name = inspect.getmodule(monad).__name__
-    monad_name = monad.__name__
+        all the list comprehension into a monadic expression. The comprehensions of the
+        monads in comp_specializations are compiled into plain loops instead of binds,
+        unless specialize is False """
+    specialization = comp_specializations.get(monad) if specialize else None
 
     def wrapper(func):
-        # uncompile function
-        unc = uncompile(func.func_code)
-
-        # convert to ast and apply visitor
-        tree = parse_snippet(*unc)
-        MonadicFunctionDef(module_name, monad_name).visit(tree)
-        MonadicListComp().visit(tree)
-        ast.fix_missing_locations(tree)
-        unc[0] = tree
+        # the visitor converting the ast
+        comp = MonadicListComp() if specialization is None else specialization()
+        helpers = monad_helpers(monad, comp.names)
 
-        # recompile and patch function's code
-        func.func_code = recompile(*unc)
-        return func
+        # recompile with the helper functions as closure cells
+        key = ('monadic_comp', monad.__module__, monad.__name__, specialize)
+        c = factory_code(func.func_code, comp.visit, sorted(helpers), key)
+        return make_closure(func, c, helpers)
 
     return wrapper
 
 def monadic(monad):
     """ Decorator that creates helper functions within the function body and transforms
         it into a monadic expression """
-    module_name = inspect.getmodule(monad).__name__
-    monad_name = monad.__name__
-
     def wrapper(func):
-        # uncompile function
-        unc = uncompile(func.func_code)
-
-        # convert to ast and apply visitor
-        tree = parse_snippet(*unc)
-        MonadicStatement().visit(tree)
-        MonadicFunctionDef(module_name, monad_name).visit(tree)
-        ast.fix_missing_locations(tree)
-        unc[0] = tree
+        helpers = monad_helpers(monad)
 
-        # recompile and patch function's code
-        func.func_code = recompile(*unc)
-        return func
+        # recompile with the helper functions as closure cells
+        key = ('monadic', monad.__module__, monad.__name__)
+        c = factory_code(func.func_code, MonadicStatement().visit, sorted(helpers), key)
+        return make_closure(func, c, helpers)
 
     return wrapper
 
+def monad_helpers(monad, names=()):
+    """ The functions the monadic expressions use, built once when the function is
+        decorated: bind, unit and normal of monad(any_t), the monad itself and the
+        given names of contract """
+    m = monad(any_t)
+    helpers = dict((n, getattr(contract, n)) for n in ["any_t", "flat_map"] + list(names))
+    helpers[monad.__name__] = monad
+    helpers['bind'] = contract.flat_map(m)
+    helpers['unit'] = contract.unit(m)
+    ## non_monadic = unit
+    helpers['normal'] = helpers['unit']
+    return helpers
+
+def factory_code(c, transform, params, monad_key):
+    """ The code of a factory function, whose parameters are params, making the function
+        of the code object converted by transform. The code is cached on disk. """
+    check_supported(c)
+    entry = code_cache_entry(c, params, monad_key)
+    factory = load_code(entry)
+    if factory is None:
+        unc = uncompile_tree(c)
+        transform(unc[0])
+        factory = recompile_factory(params, *unc)
+        store_code(entry, factory)
+    return factory
+
+def recompile_factory(params, source, filename, mode, flags=0, firstlineno=1, privateprefix=None):
+    """ Compiles the function of the ast within a factory function, whose parameters are
+        params, returning the function. The function sees the parameters as closure cells. """
+    node = source.body[0]
+    # the factory makes the function itself, the decorators are already running
+    node.decorator_list = []
+    args = ast.arguments(args=[ast.Name(id=n, ctx=ast.Param()) for n in params], vararg=None, kwarg=None, defaults=[])
+    factory = ast.FunctionDef(name='factory', args=args, body=[node, ast.Return(name(node.name))], decorator_list=[])
+    source.body[0] = ast.copy_location(factory, node)
+    ast.fix_missing_locations(source)
+    c0 = compile(source, filename, mode, flags, True)
+    for c in c0.co_consts:
+        if isinstance(c, code) and c.co_name == 'factory':
+            return c
+    raise Error('Factory code not found')
+
+def make_closure(func, factory, helpers):
+    """ The function the factory code makes of the helpers, named as func """
+    made = function(factory, func.func_globals)(**helpers)
+    result = function(made.func_code, func.func_globals, func.__name__, func.func_defaults, made.func_closure)
+    result.__doc__ = func.__doc__
+    result.__dict__.update(func.__dict__)
+    return result
+
+# Code cache
+#
+# The factory codes are marshalled into the __pycache__ directory next to
+# the source file, one file per function and monad, as the .pyc files are
+# one per module. The file keeps the key the code was made for: the hash
+# of the source file, the function, the monad, the names of the helpers,
+# the python version, and the hash of this file, as it makes the
+# transformations. A file of another key is made again and replaced.
+# MONADIC_CACHE=off turns the cache off.
+
+code_cache_enabled = os.environ.get('MONADIC_CACHE', 'on') != 'off'
+
+## The hash of the source of the transformations, this module
+def transformer_digest():
+    return module_index(os.path.splitext(os.path.abspath(__file__))[0] + '.py').digest
+
+## The path of the cache file of the function and the key of its code, or
+## None when the cache is off
+def code_cache_entry(c, params, monad_key):
+    if not code_cache_enabled:
+        return None
+    filename = inspect.getfile(c)
+    key = (transformer_digest(), sys.version, imp.get_magic(), module_index(filename).digest, filename,
+           c.co_name, c.co_firstlineno, c.co_flags & PyCF_MASK, params, monad_key)
+    module = os.path.splitext(os.path.basename(filename))[0]
+    name = '{m}.{f}.{monad}.monadic'.format(m=module, f=c.co_name, monad='-'.join(map(str, monad_key)))
+    path = os.path.join(os.path.dirname(os.path.abspath(filename)), '__pycache__', name)
+    return path, hashlib.sha1(repr(key)).hexdigest()
+
+def load_code(entry):
+    if entry is None:
+        return None
+    path, key = entry
+    try:
+        with open(path, 'rb') as f:
+            stored, c = marshal.load(f)
+    except (IOError, EOFError, ValueError, TypeError):
+        return None
+    return c if stored == key and isinstance(c, code) else None
+
+## Stores the code, as python stores the .pyc files: a directory that can
+## not be written only means the code is not cached.
+def store_code(entry, c):
+    if entry is None:
+        return
+    path, key = entry
+    try:
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        temp = '{p}.{pid}.tmp'.format(p=path, pid=os.getpid())
+        with open(temp, 'wb') as f:
+            marshal.dump((key, c), f)
+        os.rename(temp, path)
+    except (IOError, OSError):
+        pass
+
 # Monadic bind example
 # x3 for x1 in call1
 #    for x2 in call2(x1)
@@ -165,6 +306,8 @@ def monadic(monad):
 
 class MonadicListComp(ast.NodeTransformer):
 
+    names = []
+
     def visit_ListComp(self, node):
         generators = node.generators
 
@@ -189,50 +332,152 @@ class MonadicListComp(ast.NodeTransformer):
         return newnode
 
 
-class MonadicFunctionDef(ast.NodeTransformer):
-    """ Import and declare the necessary functions to create monad abstractions """
+# Specialized comprehensions
+#
+# The comprehensions of the list monads are python generator expressions,
+# only the generators are checked as bind checks them. The comprehensions
+# of maybeMonad and try_monad become local functions returning at the
+# first failed value, e.g. for maybeMonad [y for x in just(4) for y in div(x, z)]:
+#
+# def comprehension_0():
+#     monadic_value = maybe_t(just(4))
+#     if not isinstance(monadic_value, Just):
+#         return monadic_value
+#     x = monadic_value.x
+#     monadic_value = maybe_t(div(x, z))
+#     if not isinstance(monadic_value, Just):
+#         return monadic_value
+#     y = monadic_value.x
+#     return Just(y)
+
+class NativeListComp(ast.NodeTransformer):
+    """ listMonad: the list of a generator expression over lists, python 2 list
+        comprehensions would leak their targets into the function, the binds do not """
+
+    names = ["list_t"]
 
-    def __init__(self, module_name, monad_name):
-        self.module_name = module_name
-        self.monad_name = monad_name
+    def visit_ListComp(self, node):
+        self.generic_visit(node)
+        if has_ifs(node):
+            return MonadicListComp().visit(node)
+        for g in node.generators:
+            g.iter = func_call(name('list_t'), [g.iter])
+        generator = ast.copy_location(ast.GeneratorExp(elt=node.elt, generators=node.generators), node)
+        return ast.copy_location(func_call(name('list'), [generator]), node)
+
+class LazyListComp(ast.NodeTransformer):
+    """ lazyListMonad: a generator expression """
+
+    names = []
+
+    def visit_ListComp(self, node):
+        self.generic_visit(node)
+        if has_ifs(node):
+            return MonadicListComp().visit(node)
+        return ast.copy_location(ast.GeneratorExp(elt=node.elt, generators=node.generators), node)
+
+class ShortCircuitListComp(ast.NodeTransformer):
+    """ Compiles the comprehensions into local functions of straight line code, given
+        the source of the check of a monadic value, the test of a failed value, the
+        value of a successful one and the unit of elt """
+
+    def __init__(self, check, failed, value, unit, names):
+        self.check = check
+        self.failed = failed
+        self.value = value
+        self.unit = unit
+        self.names = names
+        self.functions = []
+        # comprehensions within lambdas or comprehensions see their local
+        # names, so they stay binds
+        self.depth = 0
 
     def visit_FunctionDef(self, node):
-        monad_any_t = func_call(name(self.monad_name), [name('any_t')])
-
-        ## from contract import any_t, flat_map
-        import_contract = ast.ImportFrom(module="contract",
-                                         names=map(alias, ["any_t", "flat_map", "unit"]))
-        ast.fix_missing_locations(import_contract)
-
-        ## from monad_module import monad_name
-        import_monad = ast.ImportFrom(module=self.module_name,
-                                         names=map(alias, [self.monad_name]))
-        ast.fix_missing_locations(import_monad)
-
-        ## bind = flat_map(monad_name(any_t))
-        bind = ast.Assign(
-            [name_store('bind')],
-            func_call(name('flat_map'), [monad_any_t])
-        )
-        ast.fix_missing_locations(bind)
-
-        ## unit = unit(monad_name(any_t))
-        unit = ast.Assign(
-            [name_store('unit')],
-            func_call(name('unit'), [monad_any_t])
-        )
-        ast.fix_missing_locations(unit)
-
-        ## non_monadic = unit
-        normal = ast.Assign(
-            [name_store('normal')],
-            name('unit')
-        )
-        ast.fix_missing_locations(normal)
-
-        node.body = [import_contract, import_monad, bind, unit, normal] + node.body
+        self.generic_visit(node)
+        # defined before the first statement, at its line
+        for function in self.functions:
+            ast.copy_location(function, node.body[0])
+        node.body = self.functions + node.body
         return node
 
+    def visit_Lambda(self, node):
+        self.depth += 1
+        self.generic_visit(node)
+        self.depth -= 1
+        return node
+
+    def visit_ListComp(self, node):
+        if self.depth > 0 or has_ifs(node) or reads_targets(node):
+            self.depth += 1
+            self.generic_visit(node)
+            self.depth -= 1
+            return MonadicListComp().visit(node)
+        self.depth += 1
+        self.generic_visit(node)
+        self.depth -= 1
+        function_name = 'comprehension_{n}'.format(n=len(self.functions))
+        source = ['def {f}():'.format(f=function_name)]
+        nodes = {'elt': node.elt}
+        for i, g in enumerate(node.generators):
+            source += ['    monadic_value = {check}(iter_{i})'.format(check=self.check, i=i),
+                       '    if {failed}:'.format(failed=self.failed),
+                       '        return monadic_value',
+                       '    target_{i} = {value}'.format(i=i, value=self.value)]
+            nodes['iter_{i}'.format(i=i)] = g.iter
+            nodes['target_{i}'.format(i=i)] = g.target
+        source.append('    return {unit}'.format(unit=self.unit))
+        template = ast.parse('\n'.join(source)).body[0]
+        for n in ast.walk(template):
+            if hasattr(n, 'lineno'):
+                ast.copy_location(n, node)
+        function = fill(template, nodes)
+        number_lines(function.body, node.lineno)
+        self.functions.append(function)
+        return ast.copy_location(func_call(name(function_name), []), node)
+
+## The comprehensions filtered by if clauses stay binds, which do not filter,
+## so that the specialized comprehensions return what the binds return
+def has_ifs(node):
+    return any(g.ifs for g in node.generators)
+
+## Whether an iterable reads a target of its generator or of a later one, which
+## is a local of the function of the specialized comprehension, not yet assigned
+def reads_targets(node):
+    targets = set()
+    for g in reversed(node.generators):
+        targets.update(n.id for n in ast.walk(g.target) if isinstance(n, ast.Name))
+        if any(isinstance(n, ast.Name) and n.id in targets for n in ast.walk(g.iter)):
+            return True
+    return False
+
+## Numbers the statements of a template by the nodes filled in, as python 2
+## line number tables only go forward: a statement is on the last line of its
+## nodes, or on the line of the statement before it.
+def number_lines(statements, lineno):
+    for s in statements:
+        lineno = max([lineno] + [n.lineno for n in ast.walk(s) if hasattr(n, 'lineno')])
+        s.lineno = lineno
+        number_lines(getattr(s, 'body', []), lineno)
+    return lineno
+
+## Replaces the names of the template by the given nodes
+def fill(template, nodes):
+    class Fill(ast.NodeTransformer):
+        def visit_Name(self, node):
+            return nodes.get(node.id, node)
+    return Fill().visit(template)
+
+## The specialized comprehensions of the monads of contract.py, the other
+## monads use the generic binds of MonadicListComp.
+comp_specializations = {
+    listMonad: NativeListComp,
+    lazyListMonad: LazyListComp,
+    maybeMonad: lambda: ShortCircuitListComp('maybe_t', 'not isinstance(monadic_value, Just)',
+                                             'monadic_value.x', 'Just(elt)', ["maybe_t", "Just"]),
+    try_monad: lambda: ShortCircuitListComp('try_of', "monadic_value[0] == 'left'",
+                                            'monadic_value[1]', "['right', elt]", ["try_of"])
+}
+
 
 class MonadicStatement(ast.NodeTransformer):
     """ Transforms the function body into a monadic expression """
@@ -320,6 +565,11 @@ def aer_algebra(a, e, r, stmt):
 
 # AST Helpers
 
+def dump(node):
+    """ Prints the ast, astdump is only imported when it is used for debugging """
+    import astdump
+    astdump.indented(node)
+
 def name(n):
     return ast.Name(id=n, ctx=ast.Load())
 
@@ -0,0 +1,297 @@
+"""
+Contracts for homogeneous numeric containers.
+
+array_t only checks that a value is an array.array, list_of(c) checks
+the elements of a list one by one. array_of(c) checks the elements of an
+array.array, a memoryview or, when numpy is installed, a numpy.ndarray:
+
+    array_of(int_t)(array.array('i', [1, 2, 3]))
+
+The typecode, format or dtype of the container already tells the type
+of all of its elements, and bit_t or in_range(lo, hi) are checked by one
+operation over the whole container instead of one call per element.
+Element contracts that can not be checked that way are called for each
+element, as list_of does.
+
+columnar(list_of(prods({...}))) checks a batch of records column by
+column: the records are transposed into one column per key, and every
+field contract checks its whole column at once where it can.
+"""
+
+import array
+import operator
+import struct
+import types
+
+from contract import Contract, InRange, TypeOf, ListOf, ProdS, intern, any_t, bit_t, int_t, string_t, \
+    in_range, list_t, list_of, prods, sampled, expect_type_error
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+LONG_SIZE = array.array('l').itemsize
+
+## The python type of the elements stored with the given typecode or
+## struct format, None when it depends on the values: the unsigned 'I',
+## 'L' and 'Q' are longs in an array.array, ints or longs unpacked.
+def typecode_type(code, itemsize):
+    code = code.lstrip('@=<>!')
+    if code in ('b', 'h', 'i', 'l', 'q'):
+        return int if itemsize <= LONG_SIZE else None
+    if code in ('B', 'H'):
+        return int
+    return {'f': float, 'd': float, '?': bool, 'c': str, 'u': unicode}.get(code)
+
+dtype_types = {}
+
+## The python type of the elements of the given dtype, as tolist converts
+## them, None for the dtypes of objects.
+def dtype_type(dtype):
+    if dtype.kind not in 'biufSU':
+        return None
+    if dtype not in dtype_types:
+        dtype_types[dtype] = type(numpy.zeros(1, dtype).tolist()[0])
+    return dtype_types[dtype]
+
+def is_ndarray(a):
+    return numpy is not None and isinstance(a, numpy.ndarray)
+
+## The python type of the elements of the container
+def element_type(a):
+    if is_ndarray(a):
+        return dtype_type(a.dtype)
+    if isinstance(a, array.array):
+        return typecode_type(a.typecode, a.itemsize)
+    if isinstance(a, memoryview):
+        return typecode_type(a.format, a.itemsize)
+    raise TypeError('Expected an array.array, memoryview or numpy.ndarray found {found}'.format(found=type(a)))
+
+## The elements of a memoryview of any shape, in C order, as struct
+## unpacks them; memoryview.tolist only supports one dimensional bytes.
+def unpack(a):
+    code = a.format.lstrip('@=<>!')
+    data = a.tobytes()
+    try:
+        return list(struct.unpack('{order}{n}{code}'.format(order=a.format[0:len(a.format) - len(code)],
+                                                             n=len(data) // a.itemsize, code=code), data))
+    except struct.error:
+        raise TypeError('Unsupported memoryview format {format!r}'.format(format=a.format))
+
+## The elements of the container as python values, for the checks of the
+## elements one by one
+def elements(a):
+    if is_ndarray(a):
+        return a.ravel().tolist()
+    if isinstance(a, memoryview):
+        return unpack(a)
+    return a
+
+## The elements of the container as one value for the vectorized checks
+def numbers(a):
+    if is_ndarray(a):
+        return a
+    if isinstance(a, array.array) and len(a) > 0 and numpy is not None:
+        return numpy.frombuffer(a, dtype=a.typecode)
+    return elements(a)
+
+def all_bits(v):
+    if is_ndarray(v):
+        return bool(((v == 0) | (v == 1)).all())
+    return set(v).issubset((0, 1))
+
+def all_in_range(v, lo, hi):
+    if is_ndarray(v):
+        return v.size == 0 or bool(v.min() >= lo and v.max() < hi)
+    return len(v) == 0 or (min(v) >= lo and max(v) < hi)
+
+## Checks all the elements of the container against c in one go. Returns
+## False when that is not possible or some element failed; the elements
+## are then checked one by one, which also raises the error of c.
+def vector_check(c, a, t):
+    if c is any_t:
+        return True
+    if isinstance(c, TypeOf):
+        return t is not None and issubclass(t, c.type)
+    if t not in (int, bool, float):
+        return False
+    v = numbers(a)
+    if c is bit_t:
+        return all_bits(v)
+    # min and max skip over nan, numpy does not
+    if isinstance(c, InRange) and (t is not float or is_ndarray(v)):
+        lo, hi = c.bounds
+        return all_in_range(v, lo, hi)
+    return False
+
+class ArrayOf(Contract):
+    __slots__ = ()
+
+    def __init__(self, c):
+        Contract.__init__(self, 'array_of', [c])
+
+    def __call__(self, a):
+        c = self.children[0]
+        if not vector_check(c, a, element_type(a)):
+            for x in elements(a):
+                c(x)
+        return a
+
+## Array functor acting on contracts, the elements are checked in place,
+## the container itself is returned.
+def array_of(c):
+    return intern(ArrayOf(c))
+
+## Whether the ints of a column are floats without rounding, beyond 2**53
+## they could round onto the bounds of a range
+def exact_floats(column):
+    ints = [x for x in column if type(x) is not float]
+    return len(ints) == 0 or (min(ints) >= -2 ** 53 and max(ints) <= 2 ** 53)
+
+## Checks a whole column of values against c in one go, as vector_check
+## does for a container. The type of every value is looked up once, by
+## the set of the types in the column.
+def column_check(c, column):
+    if c is any_t:
+        return True
+    column_types = set(map(type, column))
+    if types.InstanceType in column_types:
+        return False
+    if isinstance(c, TypeOf):
+        return all(issubclass(t, c.type) for t in column_types)
+    if not (c is bit_t or isinstance(c, InRange)):
+        return False
+    if column_types <= set([int, long, bool]):
+        v = column
+    elif numpy is not None and column_types <= set([int, long, bool, float]) and exact_floats(column):
+        v = numpy.asarray(column, dtype=float)
+    else:
+        return False
+    if c is bit_t:
+        return all_bits(v)
+    lo, hi = c.bounds
+    return all_in_range(v, lo, hi)
+
+def annotate(e, message):
+    return e.__class__('{message}: {error}'.format(message=message, error=e))
+
+## Finds the first failing record, the same one list_of(prods(...)) fails
+## on, and raises its error naming the index and the key of the record.
+def report(fields, records, indices=None):
+    list_t(records)
+    for index, record in zip(indices or xrange(0, len(records)), records):
+        try:
+            fields(record)
+        except (TypeError, KeyError) as e:
+            if isinstance(record, dict) and len(record) == len(fields.children):
+                for k, c in fields.children:
+                    try:
+                        c(record[k])
+                    except (TypeError, KeyError) as e:
+                        raise annotate(e, 'Record {index}, key {key!r}'.format(index=index, key=k))
+            raise annotate(e, 'Record {index}'.format(index=index))
+
+class Columnar(Contract):
+    __slots__ = ()
+
+    def __init__(self, c):
+        Contract.__init__(self, 'columnar', [c])
+
+    def __call__(self, records):
+        fields = self.children[0].children[0]
+        try:
+            return self.columns(fields, records)
+        except (TypeError, KeyError):
+            report(fields, records)
+            raise
+
+    def columns(self, fields, records):
+        list_t(records)
+        if not all(issubclass(t, dict) for t in set(map(type, records))):
+            raise TypeError('Expected a list of dicts')
+        if not set(map(len, records)) <= set([len(fields.children)]):
+            raise TypeError("Expected {length} arguments".format(length=len(fields.children)))
+        result = map(dict, records)
+        for k, c in fields.children:
+            column = map(operator.itemgetter(k), records)
+            if not column_check(c, column):
+                for record, value in zip(result, map(c, column)):
+                    record[k] = value
+        return result
+
+    ## The records for the sampled checks (see contract.sampled)
+    def parts(self, records):
+        return list_t(records)
+
+    def check_part(self, records, parts, indices):
+        fields = self.children[0].children[0]
+        sample = [records[i] for i in indices]
+        try:
+            self.columns(fields, sample)
+        except (TypeError, KeyError):
+            report(fields, sample, indices)
+            raise
+
+## Batch mode of list_of(prods(...)): the same checks and results, but
+## done column by column. Other contracts are returned as they are.
+def columnar(c):
+    if isinstance(c, ListOf) and isinstance(c.children[0], ProdS):
+        return intern(Columnar(c))
+    return c
+
+def array_of_test():
+    a = array.array('i', range(0, 10))
+    print array_of(int_t)(a) is a, array_of(in_range(0, 10))(a) is a
+    print array_of(bit_t)(array.array('b', [0, 1, 1, 0]))
+    print expect_type_error(array_of(bit_t), a)
+    print expect_type_error(array_of(in_range(0, 5)), a)
+    print expect_type_error(array_of(int_t), array.array('d', [1.5]))
+    print expect_type_error(array_of(int_t), [1, 2])
+    # the unsigned ints of an array are longs, as its elements are
+    print expect_type_error(array_of(int_t), array.array('I', [1]))
+
+def ndarray_test():
+    if numpy is None:
+        return
+    a = numpy.arange(0, 100000)
+    print array_of(int_t)(a) is a, array_of(in_range(0, 100000))(a) is a
+    print array_of(bit_t)(a % 2 == 0).dtype
+    print expect_type_error(array_of(in_range(0, 10)), a)
+    print array_of(bit_t)(memoryview(numpy.array([0, 1], dtype='B'))).tolist()
+    print array_of(in_range(0, 4))(memoryview(numpy.arange(0, 4, dtype='i').reshape(2, 2))).shape
+    # the whole array passes as its elements, converted to python values, pass
+    for dtype in ['int32', 'uint32', 'bool', 'float32']:
+        b = numpy.array([0, 1], dtype=dtype)
+        try:
+            array_of(int_t)(b)
+            passed = True
+        except TypeError:
+            passed = False
+        if passed != all(isinstance(x, int) for x in b.tolist()):
+            raise Exception("array_of(int_t) differs from its elements for {dtype}".format(dtype=dtype))
+
+def columnar_test():
+    records = list_of(prods({'i': in_range(0, 100), 's': string_t, 'b': bit_t}))
+    batch = columnar(records)
+    xs = [{'i': i % 100, 's': str(i), 'b': i % 2} for i in range(0, 10000)]
+    if batch(xs) != records(xs):
+        raise Exception("Columnar check differs from list_of(prods(...))")
+    xs[1234]['s'] = 5
+    xs[4321]['i'] = 100
+    print expect_type_error(batch, xs)
+    xs[1234] = {'i': 1, 's': 's'}
+    print expect_type_error(batch, xs)
+    print sampled(batch, count=100, seed=3).verify(xs)
+    print expect_type_error(sampled(batch, fraction=1.0), xs)
+    # an int beyond 2**53 is not rounded onto the bounds of a range
+    big = columnar(list_of(prods({'x': in_range(2 ** 60, 2 ** 61)})))
+    print expect_type_error(big, [{'x': 2 ** 60 - 1}, {'x': 2.0 ** 60}])
+
+def main():
+    array_of_test()
+    ndarray_test()
+    columnar_test()
+
+if __name__ == "__main__":
+    main()